@@ -0,0 +1,99 @@
+import sys
+
+# HIBP breach fields actually used by the mappings and their attributes.
+FIELDS = {
+    'Name': 'name',
+    'Title': 'title',
+    'Domain': 'domain',
+    'BreachDate': 'breach_date',
+    'ModifiedDate': 'modified_date',
+    'Description': 'description',
+    'DataClasses': 'data_classes',
+    'IsVerified': 'is_verified',
+}
+
+# There are only so many distinct combinations of data classes,
+# so all the breaches share the same tuples (and strings) for them.
+_data_classes = {}
+
+
+def intern_data_classes(data_classes):
+    data_classes = tuple(map(sys.intern, data_classes))
+    return _data_classes.setdefault(data_classes, data_classes)
+
+
+class Breach:
+    """
+    Compact immutable record of an HIBP breach with only the fields used by
+    the mappings. Truncated breaches (i.e. names only) have the rest of the
+    fields empty.
+    """
+
+    __slots__ = tuple(FIELDS.values())
+
+    def __init__(self, name, title=None, domain=None, breach_date=None,
+                 modified_date=None, description=None, data_classes=(),
+                 is_verified=None):
+        values = {
+            'name': name,
+            'title': title,
+            'domain': domain,
+            'breach_date': breach_date,
+            'modified_date': modified_date,
+            'description': description,
+            'data_classes': intern_data_classes(data_classes),
+            'is_verified': is_verified,
+        }
+        for attribute, value in values.items():
+            object.__setattr__(self, attribute, value)
+
+    @classmethod
+    def from_json(cls, breach):
+        """Make a record from an HIBP breach ignoring any unused fields."""
+        return cls(**{
+            attribute: breach[field]
+            for field, attribute in FIELDS.items()
+            if field in breach
+        })
+
+    def to_json(self):
+        """Convert the record back to an HIBP breach (without empty fields)."""
+        breach = {}
+        for field, attribute in FIELDS.items():
+            value = getattr(self, attribute)
+            if field == 'DataClasses':
+                value = list(value) or None
+            if value is not None:
+                breach[field] = value
+        return breach
+
+    def size(self):
+        """Approximate the number of bytes taken by the record itself."""
+        # Data classes are shared, so they don't count.
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(getattr(self, attribute))
+            for attribute in self.__slots__
+            if attribute != 'data_classes'
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, Breach):
+            return NotImplemented
+        return all(
+            getattr(self, attribute) == getattr(other, attribute)
+            for attribute in self.__slots__
+        )
+
+    def __hash__(self):
+        return hash(tuple(
+            getattr(self, attribute) for attribute in self.__slots__
+        ))
+
+    def __repr__(self):
+        return f'{type(self).__name__}(name={self.name!r})'
@@ -0,0 +1,100 @@
+import time
+
+from flask import current_app
+
+from api.metrics import breaker_state, breaker_transitions
+from api.shared import SharedTable
+
+CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+STATES = {CLOSED: 'closed', OPEN: 'open', HALF_OPEN: 'half-open'}
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker shared by all the worker processes.
+
+    It opens after a run of failures (e.g. HIBP timeouts or 503s), so calls
+    fail fast instead of piling up behind a degraded service. After the
+    cool-down it lets a few trial calls through (i.e. half-open) and closes
+    again only if all of them succeed, or opens again on any failure.
+    Trials which never report back are given up after another cool-down.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._table = SharedTable(
+            'circuit-breakers',
+            ('state', 'failures', 'changed_at', 'trials', 'successes'),
+            capacity=16,
+        )
+
+    def _transition(self, values, state, now):
+        previous = values['state']
+
+        values.update(state=state, failures=0, changed_at=now,
+                      trials=0, successes=0)
+
+        if previous != state:
+            current_app.logger.warning(
+                f'Circuit breaker {self.name!r} is {STATES[state]} '
+                f'(was {STATES[previous]}).'
+            )
+            breaker_transitions.inc(self.name, STATES[state])
+            breaker_state.set(self.name, value=state)
+
+    def allow(self):
+        """Tell whether a call may be made at the moment."""
+        config = current_app.config
+        cool_down = config['CIRCUIT_BREAKER_COOL_DOWN']
+
+        with self._table.record(self.name) as values:
+            state = values['state']
+            now = time.time()
+
+            if state == CLOSED:
+                return True
+
+            if now - values['changed_at'] >= cool_down:
+                self._transition(values, HALF_OPEN, now)
+            elif state == OPEN:
+                return False
+
+            if values['trials'] < config['CIRCUIT_BREAKER_TRIAL_CALLS']:
+                values['trials'] += 1
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._table.record(self.name) as values:
+            if values['state'] == HALF_OPEN:
+                values['successes'] += 1
+                if (values['successes'] >=
+                        current_app.config['CIRCUIT_BREAKER_TRIAL_CALLS']):
+                    self._transition(values, CLOSED, time.time())
+            else:
+                values['failures'] = 0
+
+    def record_failure(self):
+        threshold = current_app.config['CIRCUIT_BREAKER_FAILURE_THRESHOLD']
+
+        with self._table.record(self.name) as values:
+            now = time.time()
+
+            if values['state'] == HALF_OPEN:
+                self._transition(values, OPEN, now)
+            elif values['state'] == CLOSED:
+                values['failures'] += 1
+                if values['failures'] >= threshold:
+                    self._transition(values, OPEN, now)
+
+    def state(self):
+        values = self._table.get(self.name)
+        return STATES[values['state'] if values else CLOSED]
+
+    def clear(self):
+        self._table.clear()
+
+
+hibp_breaker = CircuitBreaker('hibp')
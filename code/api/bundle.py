@@ -1,20 +1,34 @@
 from collections import defaultdict
 
+from api.timing import timed
+
 
 class Bundle:
 
     def __init__(self):
         self._entities_by_type = defaultdict(list)
+        self._entities_by_id = {}
 
     def add(self, entity):
+        # Entities with deterministic ids (e.g. indicators for the same breach
+        # found for several emails) must be added only once, all the other
+        # entities (e.g. relationships) can still refer to them by their ids.
+        if entity['id'] in self._entities_by_id:
+            return
+        self._entities_by_id[entity['id']] = entity
+
         # Pluralize the type of an entity to make TR accept it.
         entity_type = entity['type'] + 's'
         self._entities_by_type[entity_type].append(entity)
 
+    def __len__(self):
+        return len(self._entities_by_id)
+
     @staticmethod
     def _format_docs(docs):
         return {'count': len(docs), 'docs': docs}
 
+    @timed('Bundle.json')
     def json(self):
         return {
             entity_type: self._format_docs(entities)
@@ -0,0 +1,405 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from api.shared import SharedTable
+
+
+class JWKSCache:
+    """
+    Per-process cache of already parsed JWKS public keys keyed by `jwks_host`.
+
+    Fresh entries are served directly. Entries older than the TTL are still
+    served while a background refresh runs, unless they are too stale to be
+    trusted, in which case they are refreshed synchronously. An unknown `kid`
+    forces a synchronous refresh, but no more often than once per interval.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, jwks_host, kid, fetch):
+        config = current_app.config
+
+        with self._lock:
+            entry = self._entries.get(jwks_host)
+
+        if entry is None:
+            keys = self._refresh(jwks_host, fetch, miss=True)
+            return keys.get(kid)
+
+        keys, fetched_at = entry
+        age = time.time() - fetched_at
+
+        if age > config['JWKS_CACHE_TTL'] + config['JWKS_CACHE_MAX_STALE']:
+            keys = self._refresh(jwks_host, fetch, miss=True)
+            age = 0
+        else:
+            with self._lock:
+                self.hits += 1
+            if age > config['JWKS_CACHE_TTL']:
+                self._refresh_in_background(jwks_host, fetch)
+
+        # The keys might have been rotated since the last fetch,
+        # so give the JWKS endpoint one more chance to know the `kid`.
+        if kid not in keys and age >= config['JWKS_REFRESH_MIN_INTERVAL']:
+            keys = self._refresh(jwks_host, fetch, miss=True)
+
+        return keys.get(kid)
+
+    def _refresh(self, jwks_host, fetch, miss=False):
+        if miss:
+            with self._lock:
+                self.misses += 1
+
+        keys = fetch(jwks_host)
+
+        with self._lock:
+            self._entries[jwks_host] = (keys, time.time())
+            self.refreshes += 1
+
+        return keys
+
+    def _refresh_in_background(self, jwks_host, fetch):
+        with self._lock:
+            if jwks_host in self._refreshing:
+                return
+            self._refreshing.add(jwks_host)
+
+        app = current_app._get_current_object()
+
+        def target():
+            try:
+                with app.app_context():
+                    self._refresh(jwks_host, fetch)
+            except Exception as error:
+                # Keep serving the stale keys until the next attempt.
+                app.logger.warning(
+                    f'Failed to refresh JWKS from {jwks_host}: {error!r}'
+                )
+            finally:
+                with self._lock:
+                    self._refreshing.discard(jwks_host)
+
+        threading.Thread(target=target, daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.refreshes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'size': len(self._entries),
+        }
+
+
+class LRUCache:
+    """
+    Per-process LRU cache bounded by the number of entries, where each entry
+    may also expire at its own point in time.
+
+    The maximum size is read from the app config by the given option name.
+    """
+
+    def __init__(self, max_size_option):
+        self._max_size_option = max_size_option
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value, expires_at=None):
+        max_size = current_app.config[self._max_size_option]
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+        }
+
+
+class BreachCache:
+    """
+    Per-process LRU cache of HIBP lookups bounded by the total size in bytes.
+
+    Entries are keyed by a hash of the API key, the normalized email and the
+    truncate flag, so plaintext addresses are never kept in memory. Breaches
+    are immutable records, so hits share them instead of copying, and their
+    sizes are approximated by the records themselves. Negative results (i.e.
+    emails not found in any breach) have their own TTL. Expired entries are
+    kept until evicted, so they can still be served while HIBP is down.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(key, email, truncate):
+        email = email.strip().lower()
+        return hashlib.sha256(f'{key}\n{email}\n{truncate}'.encode()).digest()
+
+    def get(self, key, email, truncate, stale=False):
+        cache_key = self.make_key(key, email, truncate)
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+
+            if entry is not None:
+                breaches, expires_at, _ = entry
+                if stale or expires_at > time.time():
+                    self._entries.move_to_end(cache_key)
+                    self.hits += 1
+                    return breaches
+
+            self.misses += 1
+            return None
+
+    @staticmethod
+    def get_ttl(breaches):
+        config = current_app.config
+        return (config['BREACH_CACHE_TTL'] if breaches
+                else config['BREACH_CACHE_NEGATIVE_TTL'])
+
+    def set(self, key, email, truncate, breaches, ttl=None):
+        config = current_app.config
+
+        cache_key = self.make_key(key, email, truncate)
+        breaches = tuple(breaches)
+        size = self._entry_size(cache_key, breaches)
+        if ttl is None:
+            ttl = self.get_ttl(breaches)
+        max_size = config['BREACH_CACHE_MAX_SIZE']
+
+        if size > max_size:
+            return
+
+        with self._lock:
+            if cache_key in self._entries:
+                self._delete(cache_key)
+
+            self._entries[cache_key] = (breaches, time.time() + ttl, size)
+            self._size += size
+
+            while self._size > max_size:
+                self._delete(next(iter(self._entries)))
+
+    @staticmethod
+    def _entry_size(cache_key, breaches):
+        return (len(cache_key) + sys.getsizeof(breaches) +
+                sum(breach.size() for breach in breaches))
+
+    def _delete(self, cache_key):
+        _, _, size = self._entries.pop(cache_key)
+        self._size -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'size': len(self._entries),
+            'bytes': self._size,
+        }
+
+
+class HealthCache:
+    """
+    Results of health checks per (hashed) HIBP API key shared by all the
+    worker processes, so repeated checks don't use up the HIBP rate limit.
+
+    Only successful checks are cached (for up to the max age), failed ones
+    are always retried. The optional background prober of each process
+    keeps checking the keys recently asked about before their results
+    expire, so those checks are answered without calling HIBP at all.
+    """
+
+    def __init__(self):
+        self._table = SharedTable('health', ('checked_at', 'probing_until'))
+        self._probes = {}
+        self._prober = None
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+
+    @staticmethod
+    def make_key(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def check(self, key, probe):
+        """
+        Return the error of the cached or the new check of the key (if any).
+        The probe is called with no arguments and must return the error.
+        """
+        config = current_app.config
+
+        cache_key = self.make_key(key)
+
+        if config['HEALTH_PROBE_ENABLED']:
+            self._watch(cache_key, probe)
+
+        if config['HEALTH_CACHE_MAX_AGE']:
+            values = self._table.get(cache_key)
+            if (values is not None and time.time() - values['checked_at'] <
+                    config['HEALTH_CACHE_MAX_AGE']):
+                with self._lock:
+                    self.hits += 1
+                return None
+
+        with self._lock:
+            self.misses += 1
+
+        return self._probe(cache_key, probe)
+
+    def _probe(self, cache_key, probe):
+        error = probe()
+
+        if not error:
+            with self._table.record(cache_key) as values:
+                values['checked_at'] = time.time()
+
+        return error
+
+    def _watch(self, cache_key, probe):
+        with self._lock:
+            self._probes[cache_key] = (probe, time.time())
+
+            # Threads don't survive forking, so each worker needs its own.
+            if self._prober is not None and self._prober[0] == os.getpid():
+                return
+
+            app = current_app._get_current_object()
+            thread = threading.Thread(
+                target=self._run_prober, args=(app,), daemon=True
+            )
+            self._prober = (os.getpid(), thread)
+
+        thread.start()
+
+    def _run_prober(self, app):
+        while True:
+            time.sleep(app.config['HEALTH_PROBE_INTERVAL'])
+
+            try:
+                with app.app_context():
+                    self.probe_expiring()
+            except Exception as error:
+                app.logger.warning(f'Failed to probe health: {error!r}')
+
+    def probe_expiring(self):
+        """
+        Check the keys asked about recently again if their cached results
+        would expire before the next round, unless another worker does it.
+        """
+        config = current_app.config
+
+        interval = config['HEALTH_PROBE_INTERVAL']
+        max_age = config['HEALTH_CACHE_MAX_AGE']
+        now = time.time()
+
+        with self._lock:
+            # Stop probing the keys nobody has asked about for a while.
+            self._probes = {
+                cache_key: (probe, requested_at)
+                for cache_key, (probe, requested_at) in self._probes.items()
+                if now - requested_at < config['HEALTH_PROBE_IDLE_TIMEOUT']
+            }
+            probes = list(self._probes.items())
+
+        for cache_key, (probe, _) in probes:
+            with self._table.record(cache_key) as values:
+                expiring = values['checked_at'] + max_age < now + interval
+                claimed = values['probing_until'] > now
+                if expiring and not claimed:
+                    values['probing_until'] = now + interval
+
+            if expiring and not claimed:
+                with self._lock:
+                    self.probes += 1
+                error = self._probe(cache_key, probe)
+                if error:
+                    current_app.logger.warning(
+                        f'Health probe has failed: {error}'
+                    )
+
+    def clear(self):
+        with self._lock:
+            self._probes.clear()
+            self.hits = self.misses = self.probes = 0
+        self._table.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'probes': self.probes,
+            'watched': len(self._probes),
+        }
+
+
+jwks_cache = JWKSCache()
+
+token_cache = LRUCache('JWT_CACHE_MAX_SIZE')
+
+breach_cache = BreachCache()
+
+indicator_cache = LRUCache('INDICATOR_CACHE_MAX_SIZE')
+
+health_cache = HealthCache()
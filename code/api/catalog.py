@@ -0,0 +1,142 @@
+import threading
+import time
+from functools import partial
+
+from flask import current_app
+
+from api import client
+from api.parsing import CHUNK_SIZE, iter_breaches, parse_breaches
+
+
+class BreachCatalog:
+    """
+    Per-process catalog of all the HIBP breaches keyed by their names.
+
+    The catalog is loaded either from a file snapshot (if configured) or from
+    the HIBP `/breaches` endpoint, and is periodically refreshed in the
+    background. It allows to look up emails with truncated responses (i.e.
+    breach names only) and to take the rest of the breach fields from here.
+    """
+
+    def __init__(self):
+        self._breaches = {}
+        self._loaded_at = 0
+        self._failed_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        config = current_app.config
+
+        if config['BREACH_CATALOG_FILE']:
+            with open(config['BREACH_CATALOG_FILE'], 'rb') as file:
+                chunks = iter(partial(file.read, CHUNK_SIZE), b'')
+                breaches = list(iter_breaches(chunks))
+        else:
+            headers = {'User-Agent': config['CTR_USER_AGENT']}
+            response = client.get(
+                config['HIBP_BREACHES_URL'], headers=headers, stream=True
+            )
+            response.raise_for_status()
+            breaches = parse_breaches(response)
+
+        breaches = {breach.name: breach for breach in breaches}
+
+        with self._lock:
+            self._breaches = breaches
+            self._loaded_at = time.time()
+
+    def _load_if(self, needed):
+        """
+        Load the catalog synchronously, one thread at a time, unless another
+        thread has already done it (or has just failed to) while this one has
+        been waiting, as told by `needed` once the lock is held.
+        """
+        with self._load_lock:
+            if not needed():
+                return
+
+            try:
+                self.load()
+            except Exception:
+                self._failed_at = time.time()
+                raise
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        app = current_app._get_current_object()
+
+        def target():
+            try:
+                with app.app_context():
+                    self.load()
+            except Exception as error:
+                # Keep using the outdated catalog until the next attempt.
+                app.logger.warning(
+                    f'Failed to refresh the breach catalog: {error!r}'
+                )
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=target, daemon=True).start()
+
+    def expand(self, breaches):
+        """
+        Replace truncated breaches with the full ones from the catalog.
+        Return None if the catalog is unavailable or doesn't know some names.
+        """
+        config = current_app.config
+        interval = config['BREACH_CATALOG_MIN_REFRESH_INTERVAL']
+
+        if not breaches:
+            return []
+
+        names = [breach.name for breach in breaches]
+
+        def unloaded():
+            # Don't make every request wait for a failing catalog.
+            return (not self._breaches and
+                    time.time() - self._failed_at >= interval)
+
+        def outdated():
+            # Some breaches might have been added since the last load.
+            return (any(name not in self._breaches for name in names) and
+                    time.time() - self._loaded_at > interval)
+
+        try:
+            if not self._breaches:
+                self._load_if(unloaded)
+                if not self._breaches:
+                    return None
+            elif time.time() - self._loaded_at > config['BREACH_CATALOG_TTL']:
+                self._refresh_in_background()
+
+            if outdated():
+                self._load_if(outdated)
+
+        except Exception as error:
+            current_app.logger.warning(
+                f'Failed to load the breach catalog: {error!r}'
+            )
+            return None
+
+        catalog = self._breaches
+
+        if any(name not in catalog for name in names):
+            return None
+
+        return [catalog[name] for name in names]
+
+    def clear(self):
+        with self._lock:
+            self._breaches = {}
+            self._loaded_at = self._failed_at = 0
+
+
+breach_catalog = BreachCatalog()
@@ -0,0 +1,63 @@
+import os
+import threading
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+from api import deadline
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Get the per-process pooled HTTP session shared by all the worker threads,
+    so connections (and their TLS sessions) are kept alive between calls.
+    """
+    global _session, _session_pid
+
+    # uWSGI forks its workers after the app has been loaded, so make sure to
+    # never reuse sockets which might have been opened by another process.
+    pid = os.getpid()
+
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            config = current_app.config
+
+            adapter = HTTPAdapter(
+                pool_connections=config['HTTP_POOL_CONNECTIONS'],
+                pool_maxsize=config['HTTP_POOL_MAXSIZE'],
+            )
+
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+            _session, _session_pid = session, pid
+
+        return _session
+
+
+# Requests doesn't accept zero timeouts, so time out almost immediately.
+MIN_TIMEOUT = 0.001
+
+
+def get_timeout(capped=True):
+    """Return the default timeouts capped by the request deadline (if any)."""
+    config = current_app.config
+    timeouts = config['HTTP_CONNECT_TIMEOUT'], config['HTTP_READ_TIMEOUT']
+
+    remaining = deadline.remaining()
+    if remaining is None or not capped:
+        return timeouts
+
+    remaining = max(remaining, MIN_TIMEOUT)
+    return tuple(min(timeout, remaining) for timeout in timeouts)
+
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', get_timeout())
+    return get_session().get(url, **kwargs)
@@ -0,0 +1,105 @@
+import gzip
+
+from flask import current_app, request
+
+from api.shared import SharedTable
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def compress_with_gzip(data):
+    level = current_app.config['GZIP_COMPRESSION_LEVEL']
+    return gzip.compress(data, compresslevel=level)
+
+
+def compress_with_brotli(data):
+    quality = current_app.config['BROTLI_COMPRESSION_LEVEL']
+    return brotli.compress(data, quality=quality)
+
+
+# Content codings in the order of preference (for equally accepted ones).
+COMPRESSORS = {}
+
+if brotli is not None:
+    COMPRESSORS['br'] = compress_with_brotli
+
+COMPRESSORS['gzip'] = compress_with_gzip
+
+
+class CompressionStats:
+    """
+    Number of responses and their uncompressed and compressed sizes per
+    content coding (`identity` for responses sent as is) shared by all the
+    worker processes.
+    """
+
+    def __init__(self):
+        self._table = SharedTable(
+            'compression',
+            ('responses', 'uncompressed_bytes', 'compressed_bytes'),
+            capacity=16,
+        )
+
+    def record(self, encoding, uncompressed, compressed):
+        if not current_app.config['METRICS_ENABLED']:
+            return
+
+        with self._table.record(encoding) as stats:
+            stats['responses'] += 1
+            stats['uncompressed_bytes'] += uncompressed
+            stats['compressed_bytes'] += compressed
+
+    def stats(self):
+        # Records are keyed by hashes only, so look up the known codings.
+        stats = {}
+        for encoding in ('identity', *COMPRESSORS):
+            values = self._table.get(encoding)
+            if values is not None:
+                stats[encoding] = values
+        return stats
+
+    def clear(self):
+        self._table.clear()
+
+
+compression_stats = CompressionStats()
+
+
+def negotiate_encoding():
+    """Return the most acceptable content coding supported (if any)."""
+    return request.accept_encodings.best_match(list(COMPRESSORS))
+
+
+def compress_response(response):
+    """
+    Compress JSON responses no smaller than `COMPRESSION_MIN_SIZE` with the
+    content coding negotiated through `Accept-Encoding`.
+    """
+    if (response.direct_passthrough or
+            response.mimetype != 'application/json' or
+            'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    data = response.get_data()
+    encoding = None
+
+    if len(data) >= current_app.config['COMPRESSION_MIN_SIZE']:
+        encoding = negotiate_encoding()
+
+    if encoding is None:
+        compression_stats.record('identity', len(data), len(data))
+        return response
+
+    compressed = COMPRESSORS[encoding](data)
+
+    compression_stats.record(encoding, len(data), len(compressed))
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+
+    return response
@@ -0,0 +1,55 @@
+import time
+from contextvars import ContextVar
+
+from flask import current_app, g, request
+
+# Deadline (as a timestamp) of the current request (if any). Lookups running
+# in worker threads with a copy of the request context share the deadline.
+_deadline = ContextVar('deadline', default=None)
+
+
+def get_timeout_header():
+    """Return the time (in seconds) the caller is going to wait (if known)."""
+    value = request.headers.get(current_app.config['REQUEST_TIMEOUT_HEADER'])
+
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    return timeout if timeout > 0 else None
+
+
+def start_deadline():
+    timeouts = [
+        timeout
+        for timeout in (current_app.config['REQUEST_TIMEOUT'],
+                        get_timeout_header())
+        if timeout is not None
+    ]
+
+    if timeouts:
+        g.deadline_token = _deadline.set(time.time() + min(timeouts))
+
+
+def stop_deadline(error=None):
+    token = g.pop('deadline_token', None)
+    if token is not None:
+        _deadline.reset(token)
+
+
+def get_deadline():
+    return _deadline.get()
+
+
+def remaining():
+    """Return the time (in seconds) left until the deadline (if any)."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def expired():
+    deadline = _deadline.get()
+    return deadline is not None and time.time() >= deadline
@@ -0,0 +1,47 @@
+import json
+
+from flask import current_app
+
+from api.timing import timer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_with_json(data):
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def encode_with_orjson(data):
+    return orjson.dumps(data)
+
+
+ENCODERS = {'json': encode_with_json}
+
+if orjson is not None:
+    ENCODERS['orjson'] = encode_with_orjson
+
+
+def get_encoder():
+    """
+    Return the configured response encoder or the fastest one available.
+    Unlike `jsonify`, encoders neither sort keys nor indent the output.
+    """
+    name = current_app.config['RESPONSE_ENCODER']
+
+    if name is None:
+        return ENCODERS.get('orjson', encode_with_json)
+
+    if name not in ENCODERS:
+        raise ValueError(f'Unavailable response encoder: {name!r}.')
+
+    return ENCODERS[name]
+
+
+def make_json_response(payload):
+    """Encode the payload in a single pass right into the response body."""
+    with timer('encode'):
+        body = get_encoder()(payload)
+    return current_app.response_class(body, mimetype='application/json')
@@ -1,21 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextvars import copy_context
 from functools import partial
-from operator import itemgetter
+from heapq import nlargest
+from itertools import chain
+from operator import attrgetter
 from urllib.parse import quote
 
 from flask import Blueprint, current_app
 
+from api import deadline
 from api.bundle import Bundle
+from api.compression import compress_response
 from api.mappings import Indicator, Sighting, Relationship
 from api.schemas import ObservableSchema
 from api.utils import (
-    get_json, jsonify_data, jsonify_errors, get_key, fetch_breaches
+    get_json, jsonify_data, jsonify_errors, get_key, fetch_full_breaches,
+    deadline_exceeded_error, normalize_email
 )
 
 enrich_api = Blueprint('enrich', __name__)
 
+enrich_api.after_request(compress_response)
+
 
 get_observables = partial(get_json, schema=ObservableSchema(many=True))
 
+# Errors which would fail the lookups of all the other emails too.
+FATAL_ERRORS = ('access denied', 'ssl certificate verification failed')
+
+
+def group_emails(observables):
+    """
+    Group the emails by their normalized forms keeping all of their original
+    (distinct) spellings, so each email is looked up only once, while the
+    results still refer to the observables exactly as they've been sent.
+    """
+    emails = {}
+
+    for observable in observables:
+        if observable['type'] == 'email':
+            spellings = emails.setdefault(
+                normalize_email(observable['value']), []
+            )
+            if observable['value'] not in spellings:
+                spellings.append(observable['value'])
+
+    return emails
+
+
+def fetch_breaches_concurrently(context, emails):
+    """
+    Look up the emails concurrently (capped by `HIBP_CONCURRENCY`) and yield
+    `(email, breaches, error)` tuples in the original order of the emails.
+    """
+    if not emails:
+        return
+
+    max_workers = min(current_app.config['HIBP_CONCURRENCY'], len(emails))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    # Each lookup runs in its own copy of the current context
+    # to keep the app and request contexts available to it.
+    futures = [
+        executor.submit(
+            copy_context().run, fetch_full_breaches, context, email
+        )
+        for email in emails
+    ]
+
+    try:
+        for email, future in zip(emails, futures):
+            remaining = deadline.remaining()
+            try:
+                result = future.result(
+                    timeout=None if remaining is None else max(remaining, 0)
+                )
+            except TimeoutError:
+                result = None, deadline_exceeded_error()
+            yield (email, *result)
+    finally:
+        # Don't bother looking up the rest of the emails if the caller has
+        # stopped on some error, and don't wait past the deadline for the
+        # ones still running (which are going to time out soon anyway).
+        executor.shutdown(wait=not deadline.expired(), cancel_futures=True)
+
 
 @enrich_api.route('/observe/observables', methods=['POST'])
 def observe_observables():
@@ -24,44 +93,83 @@ def observe_observables():
     if error:
         return jsonify_errors(error)
 
-    emails = [
-        observable['value']
-        for observable in observables
-        if observable['type'] == 'email'
-    ]
+    emails = group_emails(observables)
 
-    key = get_key()
+    context = get_key()
 
     bundle = Bundle()
 
-    limit = current_app.config['CTR_ENTITIES_LIMIT']
+    limit = context.ctr_entities_limit
+
+    # Each breach is mapped to (up to) 3 entities, so the optional budget for
+    # the whole bundle also limits the number of breaches per email.
+    budget = current_app.config['CTR_BUNDLE_ENTITIES_LIMIT']
+
+    # Either report errors of single emails as warnings, or fail on them.
+    partial_results = current_app.config['PARTIAL_RESULTS_ENABLED']
+
+    lookups = fetch_breaches_concurrently(context, list(emails))
+
+    warnings = []
 
-    for email in emails:
-        breaches, error = fetch_breaches(key, email)
+    deadline_exceeded = False
+
+    for email, breaches, error in lookups:
+        if error and error['code'] == 'deadline exceeded':
+            # Skip the email only, as the rest might have still completed in
+            # time (e.g. cached ones), and warn about the deadline just once.
+            if not deadline_exceeded:
+                warnings.append(error)
+                deadline_exceeded = True
+            continue
+
+        if error and partial_results and error['code'] not in FATAL_ERRORS:
+            # Keep going, so the rest of the emails don't have to be looked
+            # up again (and again count towards the HIBP rate limit) later.
+            # Refer to the email exactly as it's been sent by the caller.
+            spellings = ', '.join(emails[email])
+            warnings.append({
+                'code': error['code'],
+                'message': f'Failed to look up {spellings}: '
+                           f'{error["message"]}',
+            })
+            continue
 
         if error:
-            return jsonify_errors(error, data=bundle.json())
+            return jsonify_errors(
+                error, data=bundle.json(), warnings=warnings
+            )
 
-        breaches.sort(key=itemgetter('BreachDate'), reverse=True)
+        # Select the most recent breaches without sorting all of them.
+        breaches = nlargest(limit, breaches, key=attrgetter('breach_date'))
 
-        breaches = breaches[:limit]
+        # Each spelling of the email is a separate observable.
+        for spelling in emails[email]:
+            if budget is not None:
+                limit = min(limit, (budget - len(bundle)) // 3)
+            if limit <= 0:
+                break
 
-        source_uri = current_app.config['HIBP_UI_URL'].format(
-            email=quote(email, safe='')
-        )
+            source_uri = current_app.config['HIBP_UI_URL'].format(
+                email=quote(spelling, safe='')
+            )
 
-        for breach in breaches:
-            indicator = Indicator.map(breach)
-            sighting = Sighting.map(breach, email, source_uri)
-            relationship = Relationship.map(indicator, sighting)
+            for breach in breaches[:limit]:
+                indicator = Indicator.map(breach)
+                sighting = Sighting.map(breach, spelling, source_uri)
+                relationship = Relationship.map(indicator, sighting)
 
-            bundle.add(indicator)
-            bundle.add(sighting)
-            bundle.add(relationship)
+                bundle.add(indicator)
+                bundle.add(sighting)
+                bundle.add(relationship)
+
+        if limit <= 0:
+            # Stop looking up the rest of the emails too.
+            break
 
     data = bundle.json()
 
-    return jsonify_data(data)
+    return jsonify_data(data, warnings=warnings)
 
 
 @enrich_api.route('/refer/observables', methods=['POST'])
@@ -71,11 +179,8 @@ def refer_observables():
     if error:
         return jsonify_errors(error)
 
-    emails = [
-        observable['value']
-        for observable in observables
-        if observable['type'] == 'email'
-    ]
+    # Each distinct spelling of an email is a separate observable.
+    emails = chain.from_iterable(group_emails(observables).values())
 
     data = [
         {
@@ -1,17 +1,32 @@
+from functools import partial
+
 from flask import Blueprint, current_app
 
+from api.cache import health_cache
 from api.utils import get_key, fetch_breaches, jsonify_errors, jsonify_data
 
 health_api = Blueprint('health', __name__)
 
 
+def check_health(context):
+    # Use some breached email just to check that the HIBP API key is valid,
+    # so make sure to actually call HIBP instead of looking up the cache.
+    email = current_app.config['HIBP_TEST_EMAIL']
+    _, error = fetch_breaches(context, email, truncate=True, cache=False)
+    return error
+
+
 @health_api.route('/health', methods=['POST'])
 def health():
-    key = get_key()
+    # The JWT is verified on every request, only HIBP checks are cached.
+    context = get_key()
 
-    # Use some breached email just to check that the HIBP API key is valid.
-    email = current_app.config['HIBP_TEST_EMAIL']
-    _, error = fetch_breaches(key, email, truncate=True)
+    if context.key is None:
+        error = check_health(context)
+    else:
+        error = health_cache.check(
+            context.key, partial(check_health, context)
+        )
 
     if error:
         return jsonify_errors(error)
@@ -1,3 +1,5 @@
+import hashlib
+import json
 from abc import ABC, abstractmethod
 from uuid import uuid4, uuid5
 from typing import Dict, Any
@@ -5,6 +7,10 @@ from typing import Dict, Any
 from flask import current_app
 from markdownify import markdownify
 
+from api.breach import Breach
+from api.cache import indicator_cache
+from api.timing import timed
+
 
 JSON = Dict[str, Any]
 
@@ -38,32 +44,62 @@ class Indicator(Mapping):
     }
 
     @classmethod
-    def map(cls, breach: JSON) -> JSON:
+    @timed('Indicator.map')
+    def map(cls, breach: Breach) -> JSON:
+        # Converting descriptions to Markdown is quite expensive, so reuse
+        # indicators already built for the same version of the breach.
+        cache_key = (breach.name, cls._fingerprint(breach))
+
+        indicator = indicator_cache.get(cache_key)
+        if indicator is None:
+            indicator = cls._map(breach)
+            indicator_cache.set(cache_key, indicator)
+
+        # Make sure that callers can't mutate the cached indicator.
+        return {
+            **indicator,
+            'valid_time': indicator['valid_time'].copy(),
+            'tags': indicator['tags'].copy(),
+        }
+
+    @staticmethod
+    def _fingerprint(breach: Breach) -> str:
+        if breach.modified_date:
+            return breach.modified_date
+
+        content = json.dumps([
+            breach.title, breach.breach_date, breach.description,
+            breach.data_classes, breach.is_verified,
+        ])
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    @classmethod
+    def _map(cls, breach: Breach) -> JSON:
         indicator: JSON = cls.DEFAULTS.copy()
 
-        indicator['id'] = transient_id(indicator, breach["Name"])
+        indicator['id'] = transient_id(indicator, breach.name)
 
         # `BreachDate` itself is just a date with no time (i.e. YYYY-MM-DD),
         # so make sure to add some time to make the date comply with ISO 8601.
         indicator['valid_time'] = {
-            'start_time': breach['BreachDate'] + 'T00:00:00Z'
+            'start_time': breach.breach_date + 'T00:00:00Z'
         }
 
-        indicator['confidence'] = ['Medium', 'High'][breach['IsVerified']]
+        indicator['confidence'] = ['Medium', 'High'][breach.is_verified]
 
         # `Description` contains an overview of the breach represented in HTML,
         # so convert its contents to Markdown to make it comply with CTIM.
-        indicator['description'] = markdownify(breach['Description'])
+        indicator['description'] = markdownify(breach.description)
 
         indicator['severity'] = ['Medium', 'High'][
-            breach['IsVerified'] and 'Passwords' in breach['DataClasses']
+            breach.is_verified and 'Passwords' in breach.data_classes
         ]
 
-        indicator['short_description'] = breach['Title']
+        indicator['short_description'] = breach.title
 
-        indicator['tags'] = breach['DataClasses']
+        indicator['tags'] = list(breach.data_classes)
 
-        indicator['title'] = breach['Name']
+        indicator['title'] = breach.name
 
         return indicator
 
@@ -79,39 +115,40 @@ class Sighting(Mapping):
     }
 
     @classmethod
-    def map(cls, breach: JSON, email: str, source_uri: str) -> JSON:
+    @timed('Sighting.map')
+    def map(cls, breach: Breach, email: str, source_uri: str) -> JSON:
         sighting: JSON = cls.DEFAULTS.copy()
 
-        sighting['confidence'] = ['Medium', 'High'][breach['IsVerified']]
+        sighting['confidence'] = ['Medium', 'High'][breach.is_verified]
 
         sighting['id'] = transient_id(sighting)
 
         # `BreachDate` itself is just a date with no time (i.e. YYYY-MM-DD),
         # so make sure to add some time to make the date comply with ISO 8601.
         sighting['observed_time'] = {
-            'start_time': breach['BreachDate'] + 'T00:00:00Z'
+            'start_time': breach.breach_date + 'T00:00:00Z'
         }
         sighting['observed_time']['end_time'] = (
             sighting['observed_time']['start_time']
         )
 
         sighting['description'] = (
-            f'{email} present in {breach["Title"]} breach.'
+            f'{email} present in {breach.title} breach.'
         )
 
         sighting['observables'] = [{'type': 'email', 'value': email}]
 
-        if breach['Domain']:
+        if breach.domain:
             sighting['relations'] = [{
                 'origin': sighting['source'],
-                'related': {'type': 'domain', 'value': breach['Domain']},
+                'related': {'type': 'domain', 'value': breach.domain},
                 'relation': 'Leaked_From',
                 'source': {'type': 'email', 'value': email},
                 'origin_uri': source_uri,
             }]
 
         sighting['severity'] = ['Medium', 'High'][
-            breach['IsVerified'] and 'Passwords' in breach['DataClasses']
+            breach.is_verified and 'Passwords' in breach.data_classes
         ]
 
         sighting['source_uri'] = source_uri
@@ -133,6 +170,7 @@ class Relationship(Mapping):
     }
 
     @classmethod
+    @timed('Relationship.map')
     def map(cls, indicator: JSON, sighting: JSON) -> JSON:
         relationship: JSON = cls.DEFAULTS.copy()
 
@@ -0,0 +1,431 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Blueprint, current_app, g, request
+
+from api.cache import (
+    breach_cache, health_cache, indicator_cache, jwks_cache, token_cache
+)
+from api.compression import compression_stats
+from api.shared import SharedTable
+from api.singleflight import breach_flights
+from api.store import breach_store
+
+metrics_api = Blueprint('metrics', __name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+HIBP_STATUSES = ('200', '400', '401', '404', '429', '503', 'other', 'error')
+
+CIRCUIT_BREAKERS = ('hibp',)
+
+CIRCUIT_BREAKER_STATES = ('closed', 'open', 'half-open')
+
+CACHES = {
+    'jwks': jwks_cache,
+    'token': token_cache,
+    'breach': breach_cache,
+    'indicator': indicator_cache,
+    'health': health_cache,
+    'store': breach_store,
+}
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    labels = ','.join(
+        f'{name}="{value}"' for name, value in zip(names, values)
+    )
+    return f'{{{labels}}}'
+
+
+class Metric:
+    """
+    Metric family shared by all the worker processes through a SharedTable
+    with a record per combination of label values. Records are keyed by
+    hashes only, so the label values to report must be known up front.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=(), fields=('value',)):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._table = SharedTable(f'metrics-{name}', fields, capacity=256)
+
+    @staticmethod
+    def _key(values):
+        return '\n'.join(map(str, values))
+
+    def _update(self, values, **deltas):
+        with self._table.record(self._key(values)) as record:
+            for field, delta in deltas.items():
+                record[field] += delta
+
+    def get(self, *values):
+        return self._table.get(self._key(values))
+
+    def collect(self, label_values=((),)):
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for values in label_values:
+            record = self.get(*values)
+            if record is not None:
+                lines.extend(self._samples(values, record))
+        return lines
+
+    def _samples(self, values, record):
+        labels = format_labels(self.labels, values)
+        yield f'{self.name}{labels} {format_value(record["value"])}'
+
+    def clear(self):
+        self._table.clear()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *values, amount=1):
+        self._update(values, value=amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *values, amount=1):
+        self._update(values, value=amount)
+
+    def dec(self, *values, amount=1):
+        self._update(values, value=-amount)
+
+    def set(self, *values, value):
+        with self._table.record(self._key(values)) as record:
+            record['value'] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        super().__init__(
+            name, help, labels,
+            fields=('count', 'sum', *map(str, buckets)),
+        )
+
+    def observe(self, *values, value):
+        # Buckets are stored already cumulative, as they are reported.
+        self._update(values, count=1, sum=value, **{
+            str(bucket): 1 for bucket in self.buckets if value <= bucket
+        })
+
+    def _samples(self, values, record):
+        names = (*self.labels, 'le')
+        for bucket in (*map(str, self.buckets), '+Inf'):
+            count = record['count' if bucket == '+Inf' else bucket]
+            labels = format_labels(names, (*values, bucket))
+            yield f'{self.name}_bucket{labels} {format_value(count)}'
+
+        labels = format_labels(self.labels, values)
+        yield f'{self.name}_sum{labels} {format_value(record["sum"])}'
+        yield f'{self.name}_count{labels} {format_value(record["count"])}'
+
+
+requests_total = Counter(
+    'relay_requests_total',
+    'Number of handled requests.',
+    labels=('route', 'status'),
+)
+
+request_duration = Histogram(
+    'relay_request_duration_seconds',
+    'Duration of handled requests.',
+    labels=('route',),
+)
+
+requests_in_flight = Gauge(
+    'relay_requests_in_flight',
+    'Number of requests being handled.',
+    labels=('route',),
+)
+
+hibp_request_duration = Histogram(
+    'hibp_request_duration_seconds',
+    'Duration of HIBP API calls by their status codes.',
+    labels=('status',),
+)
+
+hibp_requests_in_flight = Gauge(
+    'hibp_requests_in_flight',
+    'Number of HIBP API calls being made.',
+)
+
+rate_limit_wait = Histogram(
+    'hibp_rate_limit_wait_seconds',
+    'Time waited for the per-key HIBP rate limit before calls.',
+    buckets=(0, 0.1, 0.5, 1, 2.5, 5, 10),
+)
+
+rate_limit_rejections = Counter(
+    'hibp_rate_limit_rejections_total',
+    'Number of HIBP calls rejected as they would wait for too long.',
+)
+
+cache_lookups = Counter(
+    'relay_cache_lookups_total',
+    'Number of cache lookups by their results.',
+    labels=('cache', 'result'),
+)
+
+coalesced_lookups = Counter(
+    'relay_coalesced_lookups_total',
+    'Number of HIBP lookups served by identical concurrent ones.',
+)
+
+breaker_transitions = Counter(
+    'relay_circuit_breaker_transitions_total',
+    'Number of circuit breaker transitions by their new states.',
+    labels=('breaker', 'state'),
+)
+
+breaker_state = Gauge(
+    'relay_circuit_breaker_state',
+    'Current circuit breaker state (0 - closed, 1 - open, 2 - half-open).',
+    labels=('breaker',),
+)
+
+METRICS = (
+    requests_total, request_duration, requests_in_flight,
+    hibp_request_duration, hibp_requests_in_flight,
+    rate_limit_wait, rate_limit_rejections,
+    cache_lookups, coalesced_lookups,
+    breaker_transitions, breaker_state,
+)
+
+
+class LocalCounters:
+    """
+    Counters kept by each process on its own (e.g. cache hits), which are
+    added to the shared metrics once per request instead of once per lookup.
+    """
+
+    def __init__(self):
+        self._published = {}
+        self._lock = threading.Lock()
+
+    def _delta(self, name, value):
+        with self._lock:
+            published = self._published.get(name, 0)
+            # Local counters start over after being cleared.
+            if value < published:
+                published = 0
+            self._published[name] = value
+        return value - published
+
+    def publish(self):
+        for name, cache in CACHES.items():
+            for result in ('hits', 'misses'):
+                delta = self._delta(f'{name}.{result}', getattr(cache, result))
+                if delta:
+                    cache_lookups.inc(name, result, amount=delta)
+
+        delta = self._delta('breach_flights.saved', breach_flights.saved)
+        if delta:
+            coalesced_lookups.inc(amount=delta)
+
+    def clear(self):
+        with self._lock:
+            self._published.clear()
+
+
+local_counters = LocalCounters()
+
+
+def get_route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else '<unmatched>'
+
+
+def start_request():
+    if not current_app.config['METRICS_ENABLED']:
+        return
+
+    g.metrics_route = get_route()
+    g.metrics_started_at = time.perf_counter()
+
+    requests_in_flight.inc(g.metrics_route)
+
+
+def finish_request(response):
+    # Responses are processed even after unhandled errors (i.e. 500).
+    route = g.pop('metrics_route', None)
+    if route is None:
+        return response
+
+    duration = time.perf_counter() - g.metrics_started_at
+
+    requests_in_flight.dec(route)
+    requests_total.inc(route, f'{response.status_code // 100}xx')
+    request_duration.observe(route, value=duration)
+
+    local_counters.publish()
+
+    return response
+
+
+@contextmanager
+def track_hibp_request():
+    """
+    Track the HIBP call made within the block, which is expected to set the
+    `status` of the yielded dict to the status code of the response.
+    """
+    call = {'status': 'error'}
+
+    if not current_app.config['METRICS_ENABLED']:
+        yield call
+        return
+
+    hibp_requests_in_flight.inc()
+    started_at = time.perf_counter()
+    try:
+        yield call
+    finally:
+        duration = time.perf_counter() - started_at
+        hibp_requests_in_flight.dec()
+
+        status = str(call['status'])
+        if status not in HIBP_STATUSES:
+            status = 'other'
+        hibp_request_duration.observe(status, value=duration)
+
+
+def observe_rate_limit_wait(wait, rejected):
+    if not current_app.config['METRICS_ENABLED']:
+        return
+
+    if rejected:
+        rate_limit_rejections.inc()
+    else:
+        rate_limit_wait.observe(value=wait)
+
+
+def get_routes():
+    return [
+        rule.rule
+        for rule in current_app.url_map.iter_rules()
+        if rule.endpoint != 'static'
+    ] + ['<unmatched>']
+
+
+def collect_cache_hit_ratios():
+    lines = [
+        '# HELP relay_cache_hit_ratio Ratio of cache lookups being hits.',
+        '# TYPE relay_cache_hit_ratio gauge',
+    ]
+    for name in CACHES:
+        hits = (cache_lookups.get(name, 'hits') or {'value': 0})['value']
+        misses = (cache_lookups.get(name, 'misses') or {'value': 0})['value']
+        if hits + misses:
+            ratio = hits / (hits + misses)
+            lines.append(f'relay_cache_hit_ratio{{cache="{name}"}} {ratio!r}')
+    return lines
+
+
+def collect_compression():
+    lines = [
+        '# HELP relay_response_bytes_total '
+        'Size of JSON responses before and after compression.',
+        '# TYPE relay_response_bytes_total counter',
+    ]
+    for encoding, stats in compression_stats.stats().items():
+        for kind in ('uncompressed', 'compressed'):
+            value = format_value(stats[f'{kind}_bytes'])
+            lines.append(
+                'relay_response_bytes_total'
+                f'{{encoding="{encoding}",kind="{kind}"}} {value}'
+            )
+    return lines
+
+
+def collect_rate_limit_retries():
+    # The rate limiter reports its waits through this module itself.
+    from api.ratelimit import rate_limiter
+
+    families = (
+        ('hibp_rate_limit_retries_total', 'retries',
+         'Number of HIBP calls retried after 429 per hashed API key.'),
+        ('hibp_rate_limit_retry_wait_seconds_total', 'wait_time',
+         'Time waited before retrying HIBP calls per hashed API key.'),
+        ('hibp_rate_limit_give_ups_total', 'give_ups',
+         'Number of HIBP calls given up after 429 per hashed API key.'),
+    )
+
+    stats = rate_limiter.stats()
+
+    lines = []
+    for name, field, help in families:
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} counter')
+        for key, values in stats.items():
+            value = format_value(values[field])
+            lines.append(f'{name}{{key="{key}"}} {value}')
+    return lines
+
+
+def collect():
+    routes = get_routes()
+
+    lines = [
+        *requests_total.collect(
+            (route, status) for route in routes for status in STATUS_CLASSES
+        ),
+        *request_duration.collect((route,) for route in routes),
+        *requests_in_flight.collect((route,) for route in routes),
+        *hibp_request_duration.collect(
+            (status,) for status in HIBP_STATUSES
+        ),
+        *hibp_requests_in_flight.collect(),
+        *rate_limit_wait.collect(),
+        *rate_limit_rejections.collect(),
+        *collect_rate_limit_retries(),
+        *cache_lookups.collect(
+            (name, result) for name in CACHES for result in ('hits', 'misses')
+        ),
+        *collect_cache_hit_ratios(),
+        *coalesced_lookups.collect(),
+        *breaker_transitions.collect(
+            (name, state)
+            for name in CIRCUIT_BREAKERS for state in CIRCUIT_BREAKER_STATES
+        ),
+        *breaker_state.collect((name,) for name in CIRCUIT_BREAKERS),
+        *collect_compression(),
+    ]
+
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    for metric in METRICS:
+        metric.clear()
+    local_counters.clear()
+
+
+@metrics_api.route('/metrics', methods=['GET'])
+def metrics():
+    # Make sure this very process has reported its latest counters too.
+    local_counters.publish()
+
+    return current_app.response_class(
+        collect(), mimetype='text/plain; version=0.0.4'
+    )
@@ -0,0 +1,96 @@
+import codecs
+import json
+
+from api.breach import Breach
+
+CHUNK_SIZE = 16 * 1024
+
+WHITESPACE = ' \t\n\r'
+
+
+def iter_json_array(chunks):
+    """
+    Incrementally parse a JSON array from the chunks of its UTF-8 encoded
+    representation and yield its items one by one, so the whole array never
+    has to be loaded into memory at once.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+
+    buffer, position = '', 0
+    state = 'start'
+
+    def read_more():
+        nonlocal buffer, position
+        chunk = next(chunks, None)
+        if chunk is None:
+            remainder = text.decode(b'', final=True)
+            if not remainder:
+                raise json.JSONDecodeError(
+                    'Unexpected end of JSON array', buffer, len(buffer)
+                )
+        else:
+            remainder = text.decode(chunk)
+        buffer, position = buffer[position:] + remainder, 0
+
+    while True:
+        while position < len(buffer) and buffer[position] in WHITESPACE:
+            position += 1
+
+        if position == len(buffer):
+            read_more()
+            continue
+
+        char = buffer[position]
+
+        if state == 'start':
+            if char != '[':
+                raise json.JSONDecodeError(
+                    "Expecting '['", buffer, position
+                )
+            position += 1
+            state = 'first'
+            continue
+
+        if state in ('first', 'next') and char == ']':
+            return
+
+        if state == 'next':
+            if char != ',':
+                raise json.JSONDecodeError(
+                    "Expecting ',' delimiter", buffer, position
+                )
+            position += 1
+            state = 'item'
+            continue
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # Most likely the item is just incomplete yet.
+            read_more()
+            continue
+
+        if end == len(buffer) and not isinstance(item, (dict, list, str)):
+            # Numbers and literals might be split between chunks.
+            read_more()
+            continue
+
+        yield item
+
+        position = end
+        state = 'next'
+
+
+def iter_breaches(chunks):
+    """Parse breaches one by one keeping only the fields actually used."""
+    for breach in iter_json_array(chunks):
+        yield Breach.from_json(breach)
+
+
+def parse_breaches(response):
+    try:
+        return list(iter_breaches(response.iter_content(CHUNK_SIZE)))
+    finally:
+        response.close()
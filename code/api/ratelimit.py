@@ -0,0 +1,93 @@
+import time
+
+from flask import current_app
+
+from api.metrics import observe_rate_limit_wait
+from api.shared import SharedTable
+
+
+class RateLimiter:
+    """
+    Token bucket per HIBP API key shared by all the worker processes.
+
+    Callers reserve a token up front and then wait for their turn, but only
+    until the given deadline. Otherwise nothing is reserved, so requests known
+    to be rejected are never sent upstream. A key may also be blocked for a
+    while (e.g. after HIBP has responded with 429), which pauses all the
+    lookups for that key until the block is over.
+    """
+
+    def __init__(self):
+        self._buckets = SharedTable(
+            'rate-limits', ('tokens', 'updated_at', 'blocked_until')
+        )
+        self._retries = SharedTable(
+            'retries', ('retries', 'wait_time', 'give_ups')
+        )
+
+    def acquire(self, key, rate, deadline):
+        """
+        Wait for a token for the key given its rate (per minute).
+        Return 0 on success or the number of seconds to wait otherwise.
+        """
+        burst = current_app.config['HIBP_RATE_LIMIT_BURST'] or rate
+
+        with self._buckets.record(key) as bucket:
+            now = time.time()
+
+            if bucket['updated_at']:
+                elapsed = now - bucket['updated_at']
+                tokens = min(burst, bucket['tokens'] + elapsed * rate / 60)
+            else:
+                tokens = burst
+
+            wait = max(
+                (1 - tokens) * 60 / rate,
+                bucket['blocked_until'] - now,
+                0.0,
+            )
+
+            if now + wait <= deadline:
+                tokens -= 1
+
+            bucket['tokens'], bucket['updated_at'] = tokens, now
+
+        rejected = now + wait > deadline
+        observe_rate_limit_wait(wait, rejected)
+
+        if rejected:
+            return wait
+
+        time.sleep(wait)
+        return 0
+
+    def block(self, key, seconds):
+        with self._buckets.record(key) as bucket:
+            bucket['blocked_until'] = max(
+                bucket['blocked_until'], time.time() + seconds
+            )
+            # Empty the bucket as of the end of the block, so the lookups
+            # paused by the block are spaced out at the rate afterwards
+            # instead of all being sent at once (and rejected again).
+            bucket['tokens'] = 0
+            bucket['updated_at'] = bucket['blocked_until']
+
+    def retry(self, key, wait):
+        with self._retries.record(key) as retries:
+            retries['retries'] += 1
+            retries['wait_time'] += wait
+
+    def give_up(self, key):
+        with self._retries.record(key) as retries:
+            retries['give_ups'] += 1
+
+    def stats(self):
+        """Return the retry stats per (hashed) API key."""
+        return dict(self._retries.items())
+
+    def clear(self):
+        self._buckets.clear()
+        self._retries.clear()
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,153 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+from flask import current_app
+
+
+class SharedTable:
+    """
+    Fixed-size hash table of numeric records kept in an mmap'd file, so all
+    the uWSGI worker processes of a container share the same state.
+
+    Records are addressed by string keys which are only stored as hashes.
+    Updates are serialized across threads and processes, so keep the work
+    done while holding a record as short as possible.
+    """
+
+    KEY_SIZE = 16
+
+    def __init__(self, name, fields, capacity=1024):
+        self.name = name
+        self.fields = fields
+        self.capacity = capacity
+
+        self._struct = struct.Struct(f'{self.KEY_SIZE}s{len(fields)}d')
+        self._lock = threading.Lock()
+
+        self._fd = None
+        self._mmap = None
+        self._opened_as = None
+
+    def _open(self):
+        path = os.path.join(
+            current_app.config['SHARED_STATE_DIR'],
+            f'{self.name}-{self.capacity}x{len(self.fields)}.tbl',
+        )
+
+        # uWSGI forks its workers after the app has been loaded, and file
+        # locks are shared by forked processes, so each worker has to open
+        # the file on its own.
+        opened_as = (os.getpid(), path)
+        if self._opened_as == opened_as:
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self._struct.size * self.capacity
+
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        self._fd, self._mmap = fd, mmap.mmap(fd, size)
+        self._opened_as = opened_as
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _find(self, digest, create=False):
+        """Return the offset of the record (new one if asked) or None."""
+        start = int.from_bytes(digest[:8], 'big') % self.capacity
+        empty = bytes(self.KEY_SIZE)
+
+        for index in range(self.capacity):
+            offset = (start + index) % self.capacity * self._struct.size
+            slot = self._mmap[offset:offset + self.KEY_SIZE]
+            if slot == digest:
+                return offset
+            if slot == empty:
+                break
+        else:
+            # The table is full, so simply take over the original slot.
+            offset = start * self._struct.size
+
+        if not create:
+            return None
+
+        self._struct.pack_into(
+            self._mmap, offset, digest, *([0.0] * len(self.fields))
+        )
+        return offset
+
+    def _digest(self, key):
+        return hashlib.blake2b(
+            key.encode(), digest_size=self.KEY_SIZE
+        ).digest()
+
+    @contextmanager
+    def record(self, key):
+        """
+        Lock the record for the key and yield its values as a dict, which
+        is written back on exit. New records have all their values zeroed.
+        """
+        digest = self._digest(key)
+
+        with self._locked():
+            offset = self._find(digest, create=True)
+            _, *values = self._struct.unpack_from(self._mmap, offset)
+            values = dict(zip(self.fields, values))
+
+            yield values
+
+            self._struct.pack_into(
+                self._mmap, offset, digest,
+                *(values[field] for field in self.fields)
+            )
+
+    def get(self, key):
+        """Return the values of the record for the key (if any)."""
+        digest = self._digest(key)
+
+        with self._locked():
+            offset = self._find(digest)
+            if offset is None:
+                return None
+            _, *values = self._struct.unpack_from(self._mmap, offset)
+
+        return dict(zip(self.fields, values))
+
+    def items(self):
+        """Return `(hashed key, values)` pairs for all the records."""
+        empty = bytes(self.KEY_SIZE)
+        items = []
+
+        with self._locked():
+            for index in range(self.capacity):
+                digest, *values = self._struct.unpack_from(
+                    self._mmap, index * self._struct.size
+                )
+                if digest != empty:
+                    values = dict(zip(self.fields, values))
+                    items.append((digest.hex(), values))
+
+        return items
+
+    def clear(self):
+        with self._locked():
+            self._mmap[:] = bytes(len(self._mmap))
@@ -0,0 +1,222 @@
+import errno
+import fcntl
+import json
+import os
+import threading
+import time
+
+from flask import current_app
+
+from api import deadline
+from api.breach import Breach
+
+# Waiting for other processes is polled with the delay (in seconds) growing
+# from the min to the max, as record locks can't be waited for with timeouts.
+LOCK_POLL_MIN_DELAY = 0.001
+LOCK_POLL_MAX_DELAY = 0.05
+
+
+class Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.shared = True
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls, so only the first caller actually
+    performs the call, while the others wait for its result (or error).
+
+    Within a process callers are coalesced by their keys. Across processes
+    they are coalesced through byte-range locks on a shared lock file, with
+    results passed through a spool of short-lived files named by the keys.
+    Callers wait for other processes only until their own deadline (if any),
+    and then perform the call uncoordinated, so it may fail fast on its own.
+    Both keys and results must be safe to store on disk (e.g. no plaintext
+    emails), and results must also be JSON serializable (at least once
+    converted by the optional `encode` function, with `decode` reverting it).
+    Results rejected by the optional `share` function (e.g. errors specific
+    to the caller) are neither spooled nor passed to the waiting callers,
+    which perform the call once again on their own instead.
+    """
+
+    def __init__(self, name, encode=None, decode=None, share=None):
+        self.name = name
+        self.encode = encode or (lambda result: result)
+        self.decode = decode or (lambda result: result)
+        self.share = share or (lambda result: True)
+
+        self._calls = {}
+        self._lock = threading.Lock()
+
+        self._fd = None
+        self._opened_as = None
+        self._swept_at = 0
+
+        self.saved = 0
+
+    def do(self, key, func):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = Call()
+
+            if leader:
+                break
+
+            call.done.wait()
+            if not call.shared:
+                continue
+
+            with self._lock:
+                self.saved += 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if current_app.config['SINGLE_FLIGHT_SHARED']:
+                call.result = self._do_shared(key, func)
+            else:
+                call.result = func()
+            call.shared = self.share(call.result)
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _open(self):
+        directory = os.path.join(
+            current_app.config['SHARED_STATE_DIR'], f'{self.name}-flights'
+        )
+
+        # Record locks are held per process, so each worker process
+        # (forked by uWSGI after loading the app) must have its own file.
+        opened_as = (os.getpid(), directory)
+        if self._opened_as != opened_as:
+            os.makedirs(directory, exist_ok=True)
+            self._fd = os.open(
+                os.path.join(directory, 'locks'), os.O_RDWR | os.O_CREAT, 0o600
+            )
+            self._opened_as = opened_as
+
+        return directory
+
+    def _lock_record(self, offset):
+        """
+        Wait for the lock at the offset, but only until the deadline of the
+        current request (if any). Return whether the lock has been acquired.
+        """
+        delay = LOCK_POLL_MIN_DELAY
+
+        while True:
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                return True
+            except OSError as error:
+                if error.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+
+            remaining = deadline.remaining()
+            if remaining is not None and remaining <= 0:
+                return False
+
+            time.sleep(delay if remaining is None else min(delay, remaining))
+            delay = min(delay * 2, LOCK_POLL_MAX_DELAY)
+
+    def _do_shared(self, key, func):
+        directory = self._open()
+        path = os.path.join(directory, f'{key}.json')
+        # Locks don't need the file to actually be that large, so lock
+        # at offsets as unique as the (hex) keys to avoid any collisions.
+        offset = int(key[:15], 16)
+
+        started_at = time.time()
+
+        if not self._lock_record(offset):
+            return func()
+
+        try:
+            # Some other process might have just performed the same call
+            # while this one has been waiting for the lock.
+            try:
+                if os.stat(path).st_mtime >= started_at:
+                    with open(path) as file:
+                        result = self.decode(json.load(file))
+                    with self._lock:
+                        self.saved += 1
+                    return result
+            except (OSError, ValueError):
+                pass
+
+            result = func()
+            if not self.share(result):
+                return result
+
+            temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+            with open(temp_path, 'w') as file:
+                json.dump(self.encode(result), file)
+            os.replace(temp_path, path)
+
+            return result
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+            self._sweep(directory)
+
+    def _sweep(self, directory):
+        ttl = current_app.config['SINGLE_FLIGHT_RESULT_TTL']
+        now = time.time()
+
+        if now - self._swept_at < ttl:
+            return
+        self._swept_at = now
+
+        for entry in os.scandir(directory):
+            try:
+                if (entry.name.endswith('.json') and
+                        entry.stat().st_mtime < now - ttl):
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'saved': self.saved, 'in_flight': len(self._calls)}
+
+    def clear(self):
+        with self._lock:
+            self.saved = 0
+
+
+def encode_lookup(result):
+    breaches, error = result
+    if breaches is not None:
+        breaches = [breach.to_json() for breach in breaches]
+    return breaches, error
+
+
+def decode_lookup(result):
+    breaches, error = result
+    if breaches is not None:
+        breaches = [Breach.from_json(breach) for breach in breaches]
+    return breaches, error
+
+
+def share_lookup(result):
+    # Lookups cut short by the deadline of one request say nothing about
+    # the others, which might still have plenty of time left.
+    _, error = result
+    return error is None or error['code'] != 'deadline exceeded'
+
+
+breach_flights = SingleFlight(
+    'breaches', encode=encode_lookup, decode=decode_lookup, share=share_lookup
+)
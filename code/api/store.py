@@ -0,0 +1,228 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+
+from api.breach import Breach
+
+SCHEMA = (
+    # Let the file shrink after sweeps. This must precede anything else, as
+    # even switching the journal mode already initializes a new file.
+    'PRAGMA auto_vacuum = INCREMENTAL',
+    'PRAGMA journal_mode = WAL',
+    'CREATE TABLE IF NOT EXISTS breaches ('
+    ' key BLOB PRIMARY KEY,'
+    ' data BLOB NOT NULL,'
+    ' size INTEGER NOT NULL,'
+    ' expires_at REAL NOT NULL'
+    ')',
+    'CREATE INDEX IF NOT EXISTS breaches_expires_at ON breaches (expires_at)',
+    # The total size of all the entries kept up to date on each change,
+    # so it can be checked on inserts without scanning the whole table.
+    'CREATE TABLE IF NOT EXISTS totals ('
+    ' id INTEGER PRIMARY KEY CHECK (id = 1),'
+    ' size INTEGER NOT NULL'
+    ')',
+    'INSERT OR IGNORE INTO totals'
+    ' SELECT 1, COALESCE(SUM(size), 0) FROM breaches',
+)
+
+# Once over the max size, evict down to a bit less than that, so the very
+# next inserts don't have to evict again right away.
+EVICTION_TARGET = 0.9
+
+
+class BreachStore:
+    """
+    Optional on-disk tier of the breach cache kept in an SQLite database,
+    so cached lookups survive restarts and are shared by all the worker
+    processes. Entries are loaded lazily (i.e. on in-memory cache misses).
+
+    Entries are keyed by the same hashes as in memory and expire after the
+    same TTLs. Expired entries are swept periodically, and the entries to
+    expire first are evicted once the total size exceeds the max size.
+    The max size is checked on each insert, and also shared by the workers.
+    The store is best effort: any database errors are treated as misses.
+    """
+
+    def __init__(self):
+        self._connection = None
+        self._opened_as = None
+        self._swept_at = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_path():
+        config = current_app.config
+        return config['BREACH_STORE_FILE'] or os.path.join(
+            config['SHARED_STATE_DIR'], 'breaches.sqlite3'
+        )
+
+    def _connect(self):
+        path = self.get_path()
+
+        # SQLite connections must never be used across forks,
+        # so each worker process has to open its own one.
+        opened_as = (os.getpid(), path)
+        if self._opened_as == opened_as:
+            return self._connection
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        connection = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        for statement in SCHEMA:
+            connection.execute(statement)
+
+        self._connection, self._opened_as = connection, opened_as
+        return connection
+
+    def _execute(self, *args):
+        with self._lock:
+            return self._connect().execute(*args).fetchall()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def get(self, cache_key, stale=False):
+        """Return the breaches cached for the key along with their TTL."""
+        if not current_app.config['BREACH_STORE_ENABLED']:
+            return None
+
+        try:
+            rows = self._execute(
+                'SELECT data, expires_at FROM breaches WHERE key = ?',
+                (cache_key,),
+            )
+        except sqlite3.Error as error:
+            current_app.logger.warning(f'Failed to read breaches: {error!r}')
+            rows = []
+
+        ttl = rows[0][1] - time.time() if rows else 0
+
+        if not rows or (ttl <= 0 and not stale):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        breaches = [
+            Breach.from_json(breach) for breach in json.loads(rows[0][0])
+        ]
+        return breaches, ttl
+
+    def set(self, cache_key, breaches, ttl):
+        config = current_app.config
+
+        if not config['BREACH_STORE_ENABLED']:
+            return
+
+        data = json.dumps(
+            [breach.to_json() for breach in breaches], separators=(',', ':')
+        ).encode()
+
+        size = len(cache_key) + len(data)
+
+        try:
+            with self._transaction() as connection:
+                replaced = connection.execute(
+                    'SELECT size FROM breaches WHERE key = ?', (cache_key,)
+                ).fetchone()
+                connection.execute(
+                    'INSERT OR REPLACE INTO breaches VALUES (?, ?, ?, ?)',
+                    (cache_key, data, size, time.time() + ttl),
+                )
+                connection.execute(
+                    'UPDATE totals SET size = size + ?',
+                    (size - (replaced[0] if replaced else 0),),
+                )
+                [total] = connection.execute(
+                    'SELECT size FROM totals'
+                ).fetchone()
+
+            interval = config['BREACH_STORE_SWEEP_INTERVAL']
+            if (total > config['BREACH_STORE_MAX_SIZE'] or
+                    time.time() - self._swept_at > interval):
+                self.sweep()
+        except sqlite3.Error as error:
+            current_app.logger.warning(f'Failed to store breaches: {error!r}')
+
+    def sweep(self):
+        """Delete expired entries and then the ones over the max size."""
+        self._swept_at = now = time.time()
+        max_size = current_app.config['BREACH_STORE_MAX_SIZE']
+
+        with self._transaction() as connection:
+            connection.execute(
+                'DELETE FROM breaches WHERE expires_at < ?', (now,)
+            )
+            connection.execute(
+                'UPDATE totals SET size ='
+                ' (SELECT COALESCE(SUM(size), 0) FROM breaches)'
+            )
+            [total] = connection.execute(
+                'SELECT size FROM totals'
+            ).fetchone()
+
+            if total > max_size:
+                # Keep the latest entries to expire which still fit.
+                connection.execute(
+                    'DELETE FROM breaches WHERE expires_at <= ('
+                    ' SELECT expires_at FROM ('
+                    '  SELECT expires_at,'
+                    '  SUM(size) OVER (ORDER BY expires_at DESC) AS total'
+                    '  FROM breaches'
+                    ' ) WHERE total > ? ORDER BY expires_at DESC LIMIT 1'
+                    ')',
+                    (int(max_size * EVICTION_TARGET),),
+                )
+                connection.execute(
+                    'UPDATE totals SET size ='
+                    ' (SELECT COALESCE(SUM(size), 0) FROM breaches)'
+                )
+
+        self._execute('PRAGMA incremental_vacuum')
+
+    def clear(self):
+        with self._lock:
+            self.hits = self.misses = 0
+            self._swept_at = 0
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM breaches')
+            connection.execute('UPDATE totals SET size = 0')
+
+    def stats(self):
+        rows = self._execute(
+            'SELECT COUNT(*), (SELECT size FROM totals) FROM breaches'
+        )
+        size, total = rows[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'size': size,
+            'bytes': int(total),
+        }
+
+
+breach_store = BreachStore()
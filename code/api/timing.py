@@ -0,0 +1,109 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import current_app, g, request
+
+# Timings of the current request (if enabled). Lookups running in worker
+# threads with a copy of the request context add to the same timings.
+_timings = ContextVar('timings', default=None)
+
+
+class Timings:
+    """Total duration (in seconds) and number of calls per stage."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self._lock:
+            total, count = self._stages.get(name, (0.0, 0))
+            self._stages[name] = (total + duration, count + 1)
+
+    def stages(self):
+        with self._lock:
+            return dict(self._stages)
+
+
+def timed(name):
+    """Time each call of the decorated function as the given stage."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = _timings.get()
+            if timings is None:
+                return func(*args, **kwargs)
+
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.add(name, time.perf_counter() - started_at)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def timer(name):
+    """Time the block as the given stage."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started_at)
+
+
+def start_timings():
+    if current_app.config['SERVER_TIMING_ENABLED']:
+        g.timings_token = _timings.set(Timings())
+
+
+def emit_timings(response):
+    """
+    Report the stage timings of the request both as the `Server-Timing`
+    header and as structured log fields. Stages might run concurrently
+    (e.g. HIBP lookups), so their totals may exceed the whole request.
+    """
+    timings = _timings.get()
+    if timings is None:
+        return response
+
+    total = time.perf_counter() - timings.started_at
+    stages = timings.stages()
+
+    metrics = [
+        f'{name};dur={duration * 1000:.2f};desc="{count} calls"'
+        for name, (duration, count) in stages.items()
+    ]
+    metrics.append(f'total;dur={total * 1000:.2f}')
+    response.headers['Server-Timing'] = ', '.join(metrics)
+
+    current_app.logger.info({
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round(total * 1000, 2),
+        'timings': {
+            name: {'duration_ms': round(duration * 1000, 2), 'calls': count}
+            for name, (duration, count) in stages.items()
+        },
+    })
+
+    return response
+
+
+def stop_timings(error=None):
+    token = g.pop('timings_token', None)
+    if token is not None:
+        _timings.reset(token)
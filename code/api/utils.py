@@ -1,22 +1,38 @@
+import hashlib
 import json
+import time
+from collections import namedtuple
+from math import ceil, inf
 from http import HTTPStatus
 from json import JSONDecodeError
 from ssl import SSLCertVerificationError
 from urllib.parse import quote
 
 import jwt
-import requests
 from jwt import InvalidSignatureError, InvalidAudienceError, DecodeError
-from flask import request, current_app, jsonify
+from flask import request, current_app
 from requests.exceptions import (
     SSLError,
     ConnectionError,
     InvalidURL,
     HTTPError,
     InvalidHeader,
+    RequestException,
+    Timeout,
 )
 
+from api import client, deadline
+from api.breaker import hibp_breaker
+from api.cache import breach_cache, jwks_cache, token_cache
+from api.catalog import breach_catalog
+from api.encoding import make_json_response
+from api.metrics import track_hibp_request
 from api.errors import AuthenticationRequiredError
+from api.parsing import parse_breaches
+from api.ratelimit import rate_limiter
+from api.singleflight import breach_flights
+from api.store import breach_store
+from api.timing import timed
 
 NO_AUTH_HEADER = 'Authorization header is missing'
 WRONG_AUTH_TYPE = 'Wrong authorization type'
@@ -31,15 +47,33 @@ JWK_HOST_MISSING = ('jwks_host is missing in JWT payload. Make sure '
                     'custom_jwks_host field is present in module_type')
 WRONG_JWKS_HOST = ('Wrong jwks_host in JWT payload. Make sure domain follows '
                    'the visibility.<region>.cisco.com structure')
+JWKS_HOST_UNAVAILABLE = ('jwks_host did not respond in time. '
+                         'Please try again later.')
 
 
-def set_ctr_entities_limit(payload):
+# Per-token settings are carried along with the request instead of being
+# stored in the app config shared by all the concurrent requests.
+TokenContext = namedtuple(
+    'TokenContext', ('key', 'ctr_entities_limit', 'hibp_rate_limit')
+)
+
+
+def get_ctr_entities_limit(payload):
     try:
         ctr_entities_limit = int(payload['CTR_ENTITIES_LIMIT'])
         assert ctr_entities_limit > 0
     except (KeyError, ValueError, AssertionError):
         ctr_entities_limit = current_app.config['CTR_ENTITIES_LIMIT_DEFAULT']
-    current_app.config['CTR_ENTITIES_LIMIT'] = ctr_entities_limit
+    return ctr_entities_limit
+
+
+def get_hibp_rate_limit(payload):
+    try:
+        hibp_rate_limit = int(payload['HIBP_RATE_LIMIT'])
+        assert hibp_rate_limit > 0
+    except (KeyError, ValueError, AssertionError):
+        hibp_rate_limit = current_app.config['HIBP_RATE_LIMIT_DEFAULT']
+    return hibp_rate_limit
 
 
 def get_auth_token():
@@ -56,35 +90,60 @@ def get_auth_token():
         raise AuthenticationRequiredError(expected_errors[error.__class__])
 
 
+def fetch_public_keys(jwks_host):
+    response = client.get(f"https://{jwks_host}/.well-known/jwks")
+    response.raise_for_status()
+    jwks = response.json()
+
+    public_keys = {}
+    for jwk in jwks['keys']:
+        kid = jwk['kid']
+        public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(
+            json.dumps(jwk)
+        )
+    return public_keys
+
+
+@timed('get_public_key')
 def get_public_key(jwks_host, token):
     expected_errors = (
         ConnectionError,
         InvalidURL,
         JSONDecodeError,
-        HTTPError
+        HTTPError,
     )
     try:
-        response = requests.get(f"https://{jwks_host}/.well-known/jwks")
-        response.raise_for_status()
-        jwks = response.json()
-
-        public_keys = {}
-        for jwk in jwks['keys']:
-            kid = jwk['kid']
-            public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(
-                json.dumps(jwk)
-            )
         kid = jwt.get_unverified_header(token)['kid']
-        return public_keys.get(kid)
+        return jwks_cache.get(jwks_host, kid, fetch_public_keys)
 
+    # Slow endpoints (or the ones cut short by the request deadline) are
+    # no sign of misconfiguration. Connect timeouts are connection errors
+    # as well, so have to be handled first.
+    except Timeout:
+        raise AuthenticationRequiredError(JWKS_HOST_UNAVAILABLE)
     except expected_errors:
         raise AuthenticationRequiredError(WRONG_JWKS_HOST)
 
 
+def verify_token(token, audience):
+    jwks_payload = jwt.decode(token, options={'verify_signature': False})
+    assert 'jwks_host' in jwks_payload
+    jwks_host = jwks_payload.get('jwks_host')
+    key = get_public_key(jwks_host, token)
+    return jwt.decode(
+        token, key=key, algorithms=['RS256'], audience=[audience]
+    )
+
+
+@timed('get_key')
 def get_key():
     """
     Get authorization token and validate its signature against the public key
-    from /.well-known/jwks endpoint
+    from /.well-known/jwks endpoint, and return the token context (i.e. the
+    HIBP API key along with the other per-token settings)
+
+    Token contexts are cached until the tokens expire, so identical tokens
+    are neither decoded nor verified again.
     """
     expected_errors = {
         KeyError: WRONG_PAYLOAD_STRUCTURE,
@@ -96,17 +155,24 @@ def get_key():
     }
 
     token = get_auth_token()
+    aud = request.url_root.rstrip('/')
+    cache_key = hashlib.sha256(f'{aud} {token}'.encode()).hexdigest()
     try:
-        jwks_payload = jwt.decode(token, options={'verify_signature': False})
-        assert 'jwks_host' in jwks_payload
-        jwks_host = jwks_payload.get('jwks_host')
-        key = get_public_key(jwks_host, token)
-        aud = request.url_root
-        payload = jwt.decode(
-            token, key=key, algorithms=['RS256'], audience=[aud.rstrip('/')]
-        )
-        set_ctr_entities_limit(payload)
-        return payload['key']
+        context = token_cache.get(cache_key)
+        if context is None:
+            payload = verify_token(token, aud)
+            context = TokenContext(
+                key=payload['key'],
+                ctr_entities_limit=get_ctr_entities_limit(payload),
+                hibp_rate_limit=get_hibp_rate_limit(payload),
+            )
+            expires_at = (
+                time.time() + current_app.config['JWT_CACHE_MAX_TTL']
+            )
+            if 'exp' in payload:
+                expires_at = min(expires_at, payload['exp'])
+            token_cache.set(cache_key, context, expires_at=expires_at)
+        return context
     except tuple(expected_errors) as error:
         message = expected_errors[error.__class__]
         raise AuthenticationRequiredError(message)
@@ -126,7 +192,37 @@ def get_json(schema):
     return data, error
 
 
-def fetch_breaches(key, email, truncate=False):
+def get_retry_after(response):
+    try:
+        return max(0, int(response.headers['retry-after']))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def service_unavailable_error():
+    return {
+        'code': 'service unavailable',
+        'message': (
+            'Service temporarily unavailable. '
+            'Please try again later.'
+        ),
+    }
+
+
+def deadline_exceeded_error():
+    return {
+        'code': 'deadline exceeded',
+        'message': (
+            'Not all the observables could be looked up in time. '
+            'The results are incomplete.'
+        ),
+    }
+
+
+@timed('fetch_breaches')
+def fetch_breaches(context, email, truncate=False, cache=True):
+    key = context.key
+
     if key is None:
         error = {
             'code': 'access denied',
@@ -134,6 +230,62 @@ def fetch_breaches(key, email, truncate=False):
         }
         return None, error
 
+    cache_key = breach_cache.make_key(key, email, truncate)
+
+    if cache:
+        breaches = breach_cache.get(key, email, truncate)
+        if breaches is not None:
+            return breaches, None
+
+        # Fall back to the on-disk tier (if enabled) shared by all workers.
+        stored = breach_store.get(cache_key)
+        if stored is not None:
+            breaches, ttl = stored
+            breach_cache.set(key, email, truncate, breaches, ttl=ttl)
+            return breaches, None
+
+    requested = False
+
+    def request():
+        nonlocal requested
+        requested = True
+
+        breaches, error = request_breaches(context, email, truncate)
+        if cache and not error:
+            breach_cache.set(key, email, truncate, breaches)
+            breach_store.set(
+                cache_key, breaches, breach_cache.get_ttl(breaches)
+            )
+        return breaches, error
+
+    # Concurrent lookups of the same email share one single HIBP call.
+    breaches, error = breach_flights.do(cache_key.hex(), request)
+
+    if cache and not error and not requested:
+        # The call might have been performed by another process, which has
+        # only cached the results in its own memory (and the shared store).
+        breach_cache.set(key, email, truncate, breaches)
+
+    if error:
+        if cache and error['code'] == 'service unavailable':
+            # HIBP is down at the moment (or at least known to be recently),
+            # so rather serve outdated results than nothing at all.
+            breaches = breach_cache.get(key, email, truncate, stale=True)
+            stored = breach_store.get(cache_key, stale=True)
+            if breaches is None and stored is not None:
+                breaches, _ = stored
+            if breaches is not None:
+                return list(breaches), None
+
+        # Each caller gets its own copy as it might be modified later.
+        return None, dict(error)
+
+    return list(breaches), None
+
+
+def request_breaches(context, email, truncate):
+    key = context.key
+
     url = current_app.config['HIBP_API_URL'].format(
         email=quote(email, safe=''),
         truncate=str(truncate).lower(),
@@ -144,78 +296,216 @@ def fetch_breaches(key, email, truncate=False):
         'hibp-api-key': key,
     }
 
-    try:
-        response = requests.get(url, headers=headers)
-    except SSLError as error:
-        # Go through a few layers of wrapped exceptions.
-        error = error.args[0].reason.args[0]
-        # Assume that a certificate could not be verified.
-        assert isinstance(error, SSLCertVerificationError)
-        reason = getattr(error, 'verify_message', error.args[0]).capitalize()
-        error = {
-            'code': 'ssl certificate verification failed',
-            'message': f'Unable to verify SSL certificate: {reason}.',
-        }
-        return None, error
-    except (InvalidHeader, UnicodeEncodeError):
-        error = {
-            'code': 'access denied',
-            'message': 'Authorization failed: Access denied due to improperly '
-                       'formed hibp-api-key.'
-        }
-        return None, error
+    max_wait_deadline = time.time() + current_app.config['HIBP_MAX_WAIT']
 
-    if response.status_code == HTTPStatus.BAD_REQUEST:
-        return [], None
+    # Never wait for longer than the request itself may take.
+    request_deadline = deadline.get_deadline()
+    wait_deadline = min(max_wait_deadline, request_deadline or inf)
 
-    if response.status_code == HTTPStatus.UNAUTHORIZED:
-        message = response.json().get("message")
-        error = {
-            'code': 'access denied',
-            'message': f'Authorization failed: {message}'
-        }
-        return None, error
+    while True:
+        # Skip lookups which wouldn't make it in time anyway.
+        if deadline.expired():
+            return None, deadline_exceeded_error()
 
-    if response.status_code == HTTPStatus.NOT_FOUND:
-        return [], None
+        # Don't even wait for the rate limit while HIBP is known to be down.
+        if not hibp_breaker.allow():
+            return None, service_unavailable_error()
 
-    if response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
-        error = response.json()
-        # The HIBP API error response payload is already well formatted,
-        # so use the original message containing some suggested timeout.
+        # Wait for the shared per-key budget instead of sending requests
+        # which are already known to be rejected by HIBP with 429.
+        wait = rate_limiter.acquire(
+            key, context.hibp_rate_limit, wait_deadline
+        )
+        if wait:
+            if time.time() + wait <= max_wait_deadline:
+                return None, deadline_exceeded_error()
+
+            error = {
+                'code': 'too many requests',
+                'message': (
+                    'Rate limit is exceeded. '
+                    f'Try again in {ceil(wait)} seconds.'
+                ),
+            }
+            return None, error
+
+        timeout = client.get_timeout()
+
+        try:
+            with track_hibp_request() as call:
+                response = client.get(
+                    url, headers=headers, stream=True, timeout=timeout
+                )
+                call['status'] = response.status_code
+        except Timeout:
+            # Timeouts cut short by the deadline say nothing about HIBP.
+            if timeout != client.get_timeout(capped=False):
+                return None, deadline_exceeded_error()
+
+            hibp_breaker.record_failure()
+            return None, service_unavailable_error()
+        except SSLError as error:
+            # Go through a few layers of wrapped exceptions.
+            error = error.args[0].reason.args[0]
+            # Assume that a certificate could not be verified.
+            assert isinstance(error, SSLCertVerificationError)
+            reason = getattr(
+                error, 'verify_message', error.args[0]
+            ).capitalize()
+            error = {
+                'code': 'ssl certificate verification failed',
+                'message': f'Unable to verify SSL certificate: {reason}.',
+            }
+            return None, error
+        except ConnectionError:
+            # E.g. connections refused or reset, or DNS failures.
+            hibp_breaker.record_failure()
+            return None, service_unavailable_error()
+        except (InvalidHeader, UnicodeEncodeError):
+            error = {
+                'code': 'access denied',
+                'message': 'Authorization failed: Access denied due to '
+                           'improperly formed hibp-api-key.'
+            }
+            return None, error
+
+        if response.status_code == HTTPStatus.SERVICE_UNAVAILABLE:
+            hibp_breaker.record_failure()
+        elif response.status_code != HTTPStatus.OK:
+            # Successful responses count once their bodies are read too.
+            hibp_breaker.record_success()
+
+        if response.status_code != HTTPStatus.TOO_MANY_REQUESTS:
+            break
+
+        # HIBP tells exactly how long to wait, so pause all the other lookups
+        # for the same key too, and retry if the wait still fits the budget.
+        retry_after = get_retry_after(response)
+        if retry_after is not None:
+            rate_limiter.block(key, retry_after)
+
+        if retry_after is None or time.time() + retry_after > wait_deadline:
+            rate_limiter.give_up(key)
+
+            if (retry_after is not None and
+                    time.time() + retry_after <= max_wait_deadline):
+                response.close()
+                return None, deadline_exceeded_error()
+
+            error = response.json()
+            response.close()
+            # The HIBP API error response payload is already well formatted,
+            # so use the original message containing some suggested timeout.
+            error = {
+                'code': 'too many requests',
+                'message': error['message'],
+            }
+            return None, error
+
+        response.close()
+        rate_limiter.retry(key, retry_after)
+
+    if response.status_code == HTTPStatus.OK:
+        # Responses might be quite large, so parse breaches one by one
+        # instead of loading the whole response into memory at once.
+        try:
+            breaches = parse_breaches(response)
+        except (RequestException, ValueError):
+            # Bodies are streamed, so reading them might still time out
+            # or break off (e.g. a hung upstream or a truncated response).
+            if deadline.expired():
+                return None, deadline_exceeded_error()
+
+            hibp_breaker.record_failure()
+            return None, service_unavailable_error()
+
+        hibp_breaker.record_success()
+        return breaches, None
+
+    # Make sure to release the connection even if the body is never read.
+    with response:
+        if response.status_code == HTTPStatus.BAD_REQUEST:
+            return [], None
+
+        if response.status_code == HTTPStatus.UNAUTHORIZED:
+            message = response.json().get("message")
+            error = {
+                'code': 'access denied',
+                'message': f'Authorization failed: {message}'
+            }
+            return None, error
+
+        if response.status_code == HTTPStatus.NOT_FOUND:
+            return [], None
+
+        if response.status_code == HTTPStatus.SERVICE_UNAVAILABLE:
+            return None, service_unavailable_error()
+
+        # Any other error types aren't officially documented,
+        # so simply can't be handled in a meaningful way...
         error = {
-            'code': 'too many requests',
-            'message': error['message'],
+            'code': 'oops',
+            'message': 'Something went wrong.',
         }
         return None, error
 
-    if response.status_code == HTTPStatus.SERVICE_UNAVAILABLE:
-        error = {
-            'code': 'service unavailable',
-            'message': (
-                'Service temporarily unavailable. '
-                'Please try again later.'
-            ),
-        }
-        return None, error
 
-    # Any other error types aren't officially documented,
-    # so simply can't be handled in a meaningful way...
-    if response.status_code != HTTPStatus.OK:
-        error = {
-            'code': 'oops',
-            'message': 'Something went wrong.',
-        }
+def normalize_email(email):
+    """
+    Normalize the email, so all of its spellings are looked up only once.
+    HIBP itself doesn't tell apart addresses differing in letter case only.
+    """
+    email = email.strip().lower()
+
+    if current_app.config['EMAIL_IDN_ENABLED'] and '@' in email:
+        # Convert internationalized domain names to their ASCII form.
+        local, _, domain = email.rpartition('@')
+        try:
+            domain = domain.encode('idna').decode('ascii')
+        except UnicodeError:
+            pass
+        else:
+            email = f'{local}@{domain}'
+
+    return email
+
+
+def fetch_full_breaches(context, email):
+    """
+    Fetch the breaches of the email with all their fields. In the catalog
+    mode only breach names are fetched, and the rest comes from the catalog.
+    """
+    if not current_app.config['BREACH_CATALOG_ENABLED']:
+        return fetch_breaches(context, email)
+
+    breaches, error = fetch_breaches(context, email, truncate=True)
+    if error:
         return None, error
 
-    return response.json(), None
+    full_breaches = breach_catalog.expand(breaches)
+    if full_breaches is None:
+        # The catalog is either unavailable or outdated at the moment.
+        return fetch_breaches(context, email)
+
+    return full_breaches, None
+
+
+def format_warnings(warnings):
+    return [{**warning, 'type': 'warning'} for warning in warnings or ()]
+
+
+def jsonify_data(data, warnings=None):
+    payload = {'data': data}
 
+    # Unlike errors, warnings still let TR use the data (e.g. incomplete).
+    if warnings:
+        payload['errors'] = format_warnings(warnings)
+        current_app.logger.warning(payload)
 
-def jsonify_data(data):
-    return jsonify({'data': data})
+    return make_json_response(payload)
 
 
-def jsonify_errors(error, data=None):
+def jsonify_errors(error, data=None, warnings=None):
     # According to the official documentation, an error here means that the
     # corresponding TR module is in an incorrect state and needs to be
     # reconfigured, or the third-party service is down (for example, the API
@@ -223,10 +513,11 @@ def jsonify_errors(error, data=None):
     # https://visibility.amp.cisco.com/help/alerts-errors-warnings.
     error['type'] = 'fatal'
 
-    payload = {'errors': [error]}
+    # Keep the warnings collected so far (e.g. about the skipped emails).
+    payload = {'errors': [error, *format_warnings(warnings)]}
     if data:
         payload['data'] = data
 
     current_app.logger.error(payload)
 
-    return jsonify(payload)
+    return make_json_response(payload)
@@ -2,9 +2,12 @@ import traceback
 
 from flask import Flask, jsonify
 
+from api.deadline import start_deadline, stop_deadline
 from api.enrich import enrich_api
 from api.errors import RelayError
 from api.health import health_api
+from api.metrics import finish_request, metrics_api, start_request
+from api.timing import emit_timings, start_timings, stop_timings
 from api.version import version_api
 from api.watchdog import watchdog_api
 
@@ -13,10 +16,23 @@ app = Flask(__name__)
 app.url_map.strict_slashes = False
 app.config.from_object('config.Config')
 
+app.logger.setLevel(app.config['LOG_LEVEL'])
+
+app.before_request(start_deadline)
+app.teardown_request(stop_deadline)
+
+app.before_request(start_timings)
+app.after_request(emit_timings)
+app.teardown_request(stop_timings)
+
+app.before_request(start_request)
+app.after_request(finish_request)
+
 app.register_blueprint(health_api)
 app.register_blueprint(enrich_api)
 app.register_blueprint(version_api)
 app.register_blueprint(watchdog_api)
+app.register_blueprint(metrics_api)
 
 
 @app.errorhandler(RelayError)
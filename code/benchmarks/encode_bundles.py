@@ -0,0 +1,77 @@
+"""
+Compare the time of encoding representative bundles (i.e. 30, 150 and 300
+CTIM entities) with `jsonify` and with each available response encoder.
+
+Usage (from the `code` directory): python -m benchmarks.encode_bundles
+"""
+import timeit
+
+from flask import jsonify
+
+from api.breach import Breach
+from api.bundle import Bundle
+from api.encoding import ENCODERS
+from api.mappings import Indicator, Relationship, Sighting
+from app import app
+
+ENTITIES = [30, 150, 300]
+
+NUMBER = 200
+
+
+def make_breach(index):
+    description = (
+        f'In {2000 + index % 20}, the <a href="https://example.com">'
+        f'breach #{index}</a> exposed <em>millions</em> of accounts. '
+    ) * 4
+
+    return Breach(
+        name=f'Breach{index}',
+        title=f'Breach #{index}',
+        domain=f'breach{index}.com',
+        breach_date=f'{2000 + index % 20}-01-01',
+        modified_date='2020-01-01T00:00:00Z',
+        description=description,
+        data_classes=['Email addresses', 'Passwords', 'Usernames'],
+        is_verified=bool(index % 2),
+    )
+
+
+def make_payload(entities):
+    bundle = Bundle()
+    email = 'user@example.com'
+    source_uri = 'https://haveibeenpwned.com/account/user%40example.com'
+
+    for index in range(entities // 3):
+        breach = make_breach(index)
+        indicator = Indicator.map(breach)
+        sighting = Sighting.map(breach, email, source_uri)
+        bundle.add(indicator)
+        bundle.add(sighting)
+        bundle.add(Relationship.map(indicator, sighting))
+
+    return {'data': bundle.json()}
+
+
+def main():
+    encoders = {
+        'jsonify': lambda payload: jsonify(payload).get_data(),
+        **ENCODERS,
+    }
+
+    print(f'{"entities":<10}' +
+          ''.join(f'{name:>14}' for name in encoders) + '  (per bundle)')
+
+    with app.app_context():
+        for entities in ENTITIES:
+            payload = make_payload(entities)
+            timings = [
+                timeit.timeit(lambda: encode(payload), number=NUMBER) / NUMBER
+                for encode in encoders.values()
+            ]
+            print(f'{entities:<10}' +
+                  ''.join(f'{timing * 1e6:>11.0f} us' for timing in timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Compare the peak memory of parsing HIBP breach responses either at once
+(i.e. `response.json()`) or incrementally (i.e. `api.parsing`).
+
+Each mode runs a mixed workload of untruncated responses (from not breached
+up to heavily breached emails) in its own process and reports both the peak
+of Python allocations while parsing and the peak RSS of the whole process.
+
+Usage (from the `code` directory): python -m benchmarks.parse_breaches
+"""
+import json
+import multiprocessing
+import resource
+import tracemalloc
+
+from api.breach import Breach
+from api.parsing import CHUNK_SIZE, iter_breaches
+
+# The number of breaches per email looked up by the workload.
+WORKLOAD = [0, 1, 3, 5, 10, 20, 50, 100, 200, 400] * 5
+
+
+def make_breach(index):
+    description = (
+        f'In {2000 + index % 20}, the <a href="https://example.com">'
+        f'breach #{index}</a> exposed <em>millions</em> of accounts. '
+    ) * 12
+
+    return {
+        'Name': f'Breach{index}',
+        'Title': f'Breach #{index}',
+        'Domain': f'breach{index}.com',
+        'BreachDate': f'{2000 + index % 20}-01-01',
+        'AddedDate': '2020-01-01T00:00:00Z',
+        'ModifiedDate': '2020-01-01T00:00:00Z',
+        'PwnCount': 1000000 + index,
+        'Description': description,
+        'LogoPath': f'https://haveibeenpwned.com/Content/Images/{index}.png',
+        'DataClasses': ['Email addresses', 'Passwords', 'Usernames'],
+        'IsVerified': True,
+        'IsFabricated': False,
+        'IsSensitive': False,
+        'IsRetired': False,
+        'IsSpamList': False,
+        'IsMalware': False,
+    }
+
+
+def response_chunks(count):
+    """Simulate a response body received from a socket chunk by chunk."""
+    buffer = b'['
+    for index in range(count):
+        if index:
+            buffer += b','
+        buffer += json.dumps(make_breach(index)).encode()
+        while len(buffer) >= CHUNK_SIZE:
+            yield buffer[:CHUNK_SIZE]
+            buffer = buffer[CHUNK_SIZE:]
+    yield buffer + b']'
+
+
+def parse_at_once(chunks):
+    # This is roughly what `requests` does for `response.json()`,
+    # followed by dropping the fields never used by the mappings.
+    content = b''.join(chunks)
+    breaches = json.loads(content.decode())
+    return [Breach.from_json(breach) for breach in breaches]
+
+
+def parse_incrementally(chunks):
+    return list(iter_breaches(chunks))
+
+
+MODES = {
+    'response.json()': parse_at_once,
+    'api.parsing': parse_incrementally,
+}
+
+
+def run(mode, results):
+    parse = MODES[mode]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    parsed = 0
+    for count in WORKLOAD:
+        parsed += len(parse(response_chunks(count)))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results[mode] = (parsed, peak, rss_before, rss_after)
+
+
+def main():
+    context = multiprocessing.get_context('spawn')
+    results = context.Manager().dict()
+
+    for mode in MODES:
+        process = context.Process(target=run, args=(mode, results))
+        process.start()
+        process.join()
+
+    print(f'Workload: {len(WORKLOAD)} emails, '
+          f'{sum(WORKLOAD)} untruncated breaches in total')
+    print(f'{"mode":<18}{"parse peak":>14}{"peak RSS":>14}{"RSS growth":>14}')
+    for mode, (parsed, peak, rss_before, rss_after) in results.items():
+        # `ru_maxrss` is reported in kilobytes on Linux.
+        print(f'{mode:<18}{peak / 1024:>11.0f} KB{rss_after:>11} KB'
+              f'{rss_after - rss_before:>11} KB')
+
+
+if __name__ == '__main__':
+    main()
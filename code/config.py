@@ -1,4 +1,6 @@
 import json
+import os
+import tempfile
 from uuid import NAMESPACE_X500
 
 
@@ -15,6 +17,136 @@ class Config:
 
     CTR_ENTITIES_LIMIT_DEFAULT = 100
 
+    # The optional max number of entities in a single response for all the
+    # observables at once (in addition to the per-observable entities limit).
+    CTR_BUNDLE_ENTITIES_LIMIT = None
+
+    # Whether to keep looking up the rest of the emails after some lookup has
+    # failed and to return the errors of single emails as warnings instead.
+    PARTIAL_RESULTS_ENABLED = False
+
+    # Emails are trimmed and lowercased, so each address is looked up once
+    # no matter how it's spelled. Optionally convert IDNs to ASCII (IDNA).
+    EMAIL_IDN_ENABLED = False
+
+    # Parsed JWKS public keys are cached per `jwks_host` (in seconds).
+    # Stale keys are still served for a while during background refreshes,
+    # and an unknown `kid` may force a refresh at most once per interval.
+    JWKS_CACHE_TTL = 60 * 60
+    JWKS_CACHE_MAX_STALE = 24 * 60 * 60
+    JWKS_REFRESH_MIN_INTERVAL = 60
+
+    # Verified JWT payloads are cached until the tokens expire, but never
+    # longer than the max TTL (in seconds) to eventually catch key rotations.
+    JWT_CACHE_MAX_SIZE = 1024
+    JWT_CACHE_MAX_TTL = 5 * 60
+
+    # Pooled keep-alive HTTP connections are shared by all the threads of a
+    # worker process. Timeouts (in seconds) make sure that a hung upstream
+    # never ties up a worker thread indefinitely.
+    HTTP_POOL_CONNECTIONS = 4
+    HTTP_POOL_MAXSIZE = 10
+    HTTP_CONNECT_TIMEOUT = 3.05
+    HTTP_READ_TIMEOUT = 10
+
+    # The maximum number of emails looked up concurrently per request.
+    HIBP_CONCURRENCY = 4
+
+    # State shared by all the worker processes (e.g. rate limits) is kept in
+    # mmap'd files within this directory.
+    SHARED_STATE_DIR = os.path.join(tempfile.gettempdir(), 'tr-hibp-relay')
+
+    # Concurrent lookups of the same email are coalesced into a single HIBP
+    # call, also across processes through record locks on a shared file.
+    # Results are passed between processes through files kept for a while.
+    SINGLE_FLIGHT_SHARED = True
+    SINGLE_FLIGHT_RESULT_TTL = 60
+
+    # HIBP limits the number of requests per minute per API key depending on
+    # the subscription (e.g. 10 for Pwned 1, 50 for Pwned 2, etc.), so allow
+    # to configure the actual limit per module. Up to the burst of lookups
+    # (a full minute's budget by default) are made without waiting at all.
+    HIBP_RATE_LIMIT_DEFAULT = 10
+    HIBP_RATE_LIMIT_BURST = None
+
+    # The max time (in seconds) a single lookup may spend waiting for its
+    # rate limit budget or retrying after HIBP has responded with 429.
+    HIBP_MAX_WAIT = 10
+
+    # The time (in seconds) each request may take. Callers may also ask for
+    # a shorter one through the header. Lookups which can't make it in time
+    # are skipped, and the data collected so far is returned with a warning.
+    REQUEST_TIMEOUT = 15
+    REQUEST_TIMEOUT_HEADER = 'X-Request-Timeout'
+
+    # HIBP calls fail fast (with cached results served where available) once
+    # the threshold of timeouts or 503s in a row is reached. After the cool
+    # down (in seconds) the trial calls decide whether to close the circuit.
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+    CIRCUIT_BREAKER_COOL_DOWN = 30
+    CIRCUIT_BREAKER_TRIAL_CALLS = 3
+
+    # HIBP lookups are cached per worker process (TTLs are in seconds).
+    # Emails not found in any breach have their own TTL, and the total size
+    # of all the cached lookups is bounded by the max size (in bytes).
+    BREACH_CACHE_TTL = 6 * 60 * 60
+    BREACH_CACHE_NEGATIVE_TTL = 60 * 60
+    BREACH_CACHE_MAX_SIZE = 32 * 1024 * 1024
+
+    # In the catalog mode emails are looked up with truncated responses (i.e.
+    # breach names only), and the rest of the breach fields are taken from
+    # the local catalog of all breaches. The catalog is loaded from the file
+    # snapshot (if any) or from HIBP, and is refreshed after its TTL expires.
+    BREACH_CATALOG_ENABLED = False
+    BREACH_CATALOG_FILE = None
+    BREACH_CATALOG_TTL = 24 * 60 * 60
+    BREACH_CATALOG_MIN_REFRESH_INTERVAL = 10 * 60
+
+    # The optional on-disk tier of the breach cache (an SQLite database) is
+    # shared by all the workers and survives restarts, unless the file is on
+    # a temporary file system. Expired entries are swept periodically, and
+    # the total size of the entries (in bytes) is bounded by the max size on
+    # each insert (by evicting the entries to expire first).
+    BREACH_STORE_ENABLED = False
+    BREACH_STORE_FILE = None
+    BREACH_STORE_MAX_SIZE = 256 * 1024 * 1024
+    BREACH_STORE_SWEEP_INTERVAL = 10 * 60
+
+    # Indicators (incl. their Markdown descriptions) are cached per breach.
+    INDICATOR_CACHE_MAX_SIZE = 2048
+
+    # Successful health checks are cached per HIBP API key for the max age
+    # (0 disables caching). The optional background prober checks the keys
+    # asked about within the idle timeout again before their results expire.
+    HEALTH_CACHE_MAX_AGE = 5 * 60
+    HEALTH_PROBE_ENABLED = False
+    HEALTH_PROBE_INTERVAL = 60
+    HEALTH_PROBE_IDLE_TIMEOUT = 60 * 60
+
+    # Responses are encoded with the given encoder (i.e. 'orjson' or 'json')
+    # or with the fastest one installed (e.g. orjson if any) by default.
+    RESPONSE_ENCODER = None
+
+    # Enrichment responses at least of the min size (in bytes) are compressed
+    # with the content coding negotiated through `Accept-Encoding`, i.e. gzip
+    # or br (only if the `brotli` package is installed), at the given levels.
+    COMPRESSION_MIN_SIZE = 1024
+    GZIP_COMPRESSION_LEVEL = 6
+    BROTLI_COMPRESSION_LEVEL = 5
+
+    # Report how long each stage of a request (e.g. HIBP lookups) has taken
+    # both as the `Server-Timing` header and as structured log fields.
+    SERVER_TIMING_ENABLED = False
+
+    # Outside of debug mode the app logger would only emit warnings and
+    # errors otherwise, so make sure informational records (e.g. the stage
+    # timings above) actually make it into the logs.
+    LOG_LEVEL = 'INFO'
+
+    # Request, HIBP call, cache and rate limit metrics are aggregated across
+    # all the worker processes and exposed in the Prometheus text format.
+    METRICS_ENABLED = True
+
     HIBP_TEST_EMAIL = 'user@example.com'
 
     NAMESPACE_BASE = NAMESPACE_X500
@@ -24,4 +156,6 @@ class Config:
         '?truncateResponse={truncate}'
     )
 
+    HIBP_BREACHES_URL = 'https://haveibeenpwned.com/api/v3/breaches'
+
     HIBP_UI_URL = 'https://haveibeenpwned.com/account/{email}'
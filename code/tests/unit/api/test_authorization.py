@@ -1,9 +1,15 @@
+import time
 from http import HTTPStatus
+from unittest import mock
 
+import jwt
 from pytest import fixture
-from requests.exceptions import ConnectionError, InvalidURL
+from requests.exceptions import (
+    ConnectionError, ConnectTimeout, InvalidURL, ReadTimeout
+)
 
 from .utils import headers
+from api.cache import jwks_cache, token_cache
 from api.errors import AuthenticationRequiredError
 from tests.unit.api.mock_for_tests import (
     EXPECTED_RESPONSE_OF_JWKS_ENDPOINT,
@@ -13,6 +19,7 @@ from api.utils import (
     NO_AUTH_HEADER,
     WRONG_AUTH_TYPE,
     WRONG_JWKS_HOST,
+    JWKS_HOST_UNAVAILABLE,
     WRONG_PAYLOAD_STRUCTURE,
     JWK_HOST_MISSING,
     WRONG_KEY,
@@ -96,6 +103,23 @@ def test_call_with_wrong_jwks_host(
         )
 
 
+def test_call_with_jwks_host_timeout(
+        route, client, valid_json, valid_jwt, hibp_api_request,
+        authorization_errors_expected_payload
+):
+    for error in (ConnectTimeout, ReadTimeout):
+        hibp_api_request.side_effect = error()
+
+        response = client.post(
+            route, json=valid_json, headers=headers(valid_jwt())
+        )
+
+        assert response.status_code == HTTPStatus.OK
+        assert response.json == authorization_errors_expected_payload(
+            JWKS_HOST_UNAVAILABLE
+        )
+
+
 def test_call_with_wrong_jwt_payload_structure(
         route, client, valid_json, valid_jwt, hibp_api_request,
         rsa_api_response, authorization_errors_expected_payload
@@ -202,3 +226,124 @@ def test_call_with_wrong_kid(
     assert response.json == authorization_errors_expected_payload(
         KID_NOT_FOUND
     )
+
+
+def test_call_with_cached_jwks(
+        route, client, valid_json, valid_jwt, hibp_api_request,
+        rsa_api_response
+):
+    hibp_api_request.return_value = rsa_api_response(
+        payload=EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    # Use different tokens to make sure that they are actually verified.
+    for limit in (1, 2):
+        client.post(
+            route, json=valid_json, headers=headers(valid_jwt(limit=limit))
+        )
+
+    jwks_calls = [
+        call for call in hibp_api_request.call_args_list
+        if call.args[0].endswith('/.well-known/jwks')
+    ]
+    assert len(jwks_calls) == 1
+    assert jwks_cache.stats()['hits'] == 1
+    assert jwks_cache.stats()['misses'] == 1
+
+
+def test_call_with_stale_jwks_refreshes_in_background(
+        client, valid_json, valid_jwt, hibp_api_request, rsa_api_response
+):
+    hibp_api_request.return_value = rsa_api_response(
+        payload=EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    route = '/observe/observables'
+    client.post(route, json=valid_json, headers=headers(valid_jwt()))
+
+    config = client.application.config
+    stale_at = time.time() + config['JWKS_CACHE_TTL'] + 1
+    with mock.patch('time.time', return_value=stale_at):
+        # Use different tokens to make sure that they are actually verified.
+        client.post(
+            route, json=valid_json, headers=headers(valid_jwt(limit=2))
+        )
+
+        waited_until = time.monotonic() + 5
+        while (jwks_cache.stats()['refreshes'] < 2 and
+               time.monotonic() < waited_until):
+            time.sleep(0.01)
+
+        # The refreshed entry is fresh again, so no more refreshes.
+        client.post(
+            route, json=valid_json, headers=headers(valid_jwt(limit=3))
+        )
+
+    jwks_calls = [
+        call for call in hibp_api_request.call_args_list
+        if call.args[0].endswith('/.well-known/jwks')
+    ]
+    assert len(jwks_calls) == 2
+    assert jwks_cache.stats()['refreshes'] == 2
+    assert jwks_cache.stats()['misses'] == 1
+
+
+def test_call_with_wrong_kid_forces_jwks_refresh(
+        route, client, valid_json, valid_jwt, hibp_api_request,
+        rsa_api_response, authorization_errors_expected_payload
+):
+    hibp_api_request.return_value = rsa_api_response(
+        payload=EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    client.post(route, json=valid_json, headers=headers(valid_jwt()))
+
+    interval = client.application.config['JWKS_REFRESH_MIN_INTERVAL']
+    with mock.patch('time.time', return_value=time.time() + interval):
+        for _ in range(2):
+            response = client.post(
+                route, json=valid_json,
+                headers=headers(valid_jwt(kid='wrong_kid'))
+            )
+            assert response.json == authorization_errors_expected_payload(
+                KID_NOT_FOUND
+            )
+
+    # Only the first unknown `kid` is allowed to force a refresh.
+    assert jwks_cache.stats()['refreshes'] == 2
+
+
+def test_call_with_cached_jwt(
+        route, client, valid_json, valid_jwt, hibp_api_request,
+        rsa_api_response
+):
+    hibp_api_request.return_value = rsa_api_response(
+        payload=EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    with mock.patch('jwt.decode', wraps=jwt.decode) as decode:
+        for _ in range(2):
+            client.post(route, json=valid_json, headers=headers(valid_jwt()))
+
+    # The unverified decode plus the verified one for the first call only.
+    assert decode.call_count == 2
+    assert token_cache.stats()['hits'] == 1
+
+
+def test_call_with_cached_jwt_for_another_audience(
+        route, client, valid_json, valid_jwt, hibp_api_request,
+        rsa_api_response, authorization_errors_expected_payload
+):
+    hibp_api_request.return_value = rsa_api_response(
+        payload=EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    )
+
+    client.post(route, json=valid_json, headers=headers(valid_jwt()))
+
+    response = client.post(
+        route, json=valid_json, headers=headers(valid_jwt()),
+        base_url='http://otherhost'
+    )
+    assert response.json == authorization_errors_expected_payload(
+        WRONG_AUDIENCE
+    )
@@ -0,0 +1,71 @@
+import time
+from unittest import mock
+
+from pytest import fixture
+
+from api import metrics
+from api.breaker import CircuitBreaker
+
+
+@fixture
+def breaker(client, monkeypatch):
+    config = client.application.config
+
+    monkeypatch.setitem(config, 'CIRCUIT_BREAKER_FAILURE_THRESHOLD', 2)
+    monkeypatch.setitem(config, 'CIRCUIT_BREAKER_COOL_DOWN', 60)
+    monkeypatch.setitem(config, 'CIRCUIT_BREAKER_TRIAL_CALLS', 2)
+
+    with client.application.app_context():
+        breaker = CircuitBreaker('hibp')
+        breaker.clear()
+        yield breaker
+        breaker.clear()
+
+
+def test_breaker_opens_after_failures_in_a_row(breaker):
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+    assert breaker.state() == 'closed'
+
+    breaker.record_failure()
+    assert breaker.state() == 'open'
+    assert not breaker.allow()
+
+    assert metrics.breaker_transitions.get('hibp', 'open')['value'] == 1
+    assert metrics.breaker_state.get('hibp')['value'] == 1
+
+
+def test_breaker_closes_after_successful_trials(breaker):
+    for _ in range(2):
+        breaker.record_failure()
+
+    # Pretend the cool-down is over.
+    with mock.patch('api.breaker.time') as time_mock:
+        time_mock.time.return_value = time.time() + 60
+
+        # Only the limited number of trial calls are let through.
+        assert breaker.allow()
+        assert breaker.allow()
+        assert not breaker.allow()
+        assert breaker.state() == 'half-open'
+
+        breaker.record_success()
+        assert breaker.state() == 'half-open'
+        breaker.record_success()
+        assert breaker.state() == 'closed'
+
+
+def test_breaker_opens_again_after_failed_trial(breaker):
+    for _ in range(2):
+        breaker.record_failure()
+
+    with mock.patch('api.breaker.time') as time_mock:
+        time_mock.time.return_value = time.time() + 60
+
+        assert breaker.allow()
+        breaker.record_failure()
+
+        assert breaker.state() == 'open'
+        assert not breaker.allow()
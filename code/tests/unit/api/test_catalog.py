@@ -0,0 +1,49 @@
+import threading
+import time
+from http import HTTPStatus
+from unittest import mock
+
+from api.breach import Breach
+from api.catalog import breach_catalog
+
+
+def catalog_response():
+    mock_response = mock.MagicMock()
+    mock_response.status_code = HTTPStatus.OK
+    mock_response.iter_content = lambda chunk_size: iter([
+        b'[{"Name": "Adobe", "Title": "Adobe"}]'
+    ])
+    return mock_response
+
+
+def test_catalog_loaded_once_by_concurrent_lookups(client, hibp_api_request):
+    app = client.application
+
+    def slow_side_effect(url, **kwargs):
+        # Make sure that all the lookups are waiting for the catalog.
+        time.sleep(0.2)
+        return catalog_response()
+
+    hibp_api_request.side_effect = slow_side_effect
+
+    results = []
+
+    def expand():
+        with app.app_context():
+            results.append(breach_catalog.expand([Breach('Adobe')]))
+
+    threads = [threading.Thread(target=expand) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [[Breach('Adobe', title='Adobe')]] * 6
+    assert hibp_api_request.call_count == 1
+
+
+def test_catalog_not_loaded_for_no_breaches(client, hibp_api_request):
+    with client.application.app_context():
+        assert breach_catalog.expand([]) == []
+
+    hibp_api_request.assert_not_called()
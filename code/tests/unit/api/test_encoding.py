@@ -0,0 +1,52 @@
+import json
+
+from pytest import mark, raises
+
+from api.encoding import ENCODERS, get_encoder, make_json_response
+
+PAYLOAD = {
+    'data': {
+        'indicators': {
+            'count': 1,
+            'docs': [{
+                'id': 'transient:indicator-1',
+                'confidence': 'High',
+                'description': 'Ünïcödé "quoted" <b>text</b>',
+                'tags': ['Email addresses', 'Passwords'],
+                'valid_time': {'start_time': '2013-10-04T00:00:00Z'},
+                'count': 1,
+                'internal': False,
+            }],
+        },
+    },
+}
+
+
+@mark.parametrize('name', list(ENCODERS))
+def test_encoder_output_matches_stdlib_success(name):
+    assert json.loads(ENCODERS[name](PAYLOAD)) == PAYLOAD
+
+
+def test_encoder_selection_success(client, monkeypatch):
+    config = client.application.config
+
+    with client.application.app_context():
+        monkeypatch.setitem(config, 'RESPONSE_ENCODER', 'json')
+        assert get_encoder() is ENCODERS['json']
+
+        response = make_json_response(PAYLOAD)
+        assert response.mimetype == 'application/json'
+        assert response.get_json() == PAYLOAD
+
+        monkeypatch.setitem(config, 'RESPONSE_ENCODER', None)
+        assert get_encoder() is ENCODERS.get('orjson', ENCODERS['json'])
+
+
+def test_encoder_selection_failure(client, monkeypatch):
+    monkeypatch.setitem(
+        client.application.config, 'RESPONSE_ENCODER', 'unknown'
+    )
+
+    with client.application.app_context():
+        with raises(ValueError):
+            get_encoder()
@@ -1,12 +1,27 @@
+import gzip
+import json
+import logging
+import os
+import time
 from http import HTTPStatus
 from unittest import mock
 from unittest.mock import call
 from urllib.parse import quote
 
+from markdownify import markdownify
 from pytest import fixture
+from requests.exceptions import ConnectionError, InvalidHeader, ReadTimeout
 
 from api.mappings import Indicator, Sighting, Relationship
-from api import enrich
+from api.breach import Breach
+from api import enrich, metrics
+from api.breaker import hibp_breaker
+from api.cache import breach_cache
+from api.compression import compression_stats
+from api.ratelimit import rate_limiter
+from api.singleflight import breach_flights
+from api.store import breach_store
+from api.utils import TokenContext, fetch_breaches, normalize_email
 from tests.unit.api.mock_for_tests import EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
 from .utils import headers
 
@@ -71,61 +86,66 @@ def any_route(request):
     return request.param
 
 
-def hibp_api_response(status_code):
+def hibp_breaches():
+    description_html = (
+        'This is the <i>{id}</i> breach found on <b>HIBP</b>. Please '
+        'visit the <em>official</em> <a href="{id}.com">website</a> '
+        'to check if your account has been <strong>compromised</strong>.'
+    )
+
+    return [
+        {
+            'Name': 'FirstExposure',
+            'Title': 'First Customer Data Exposure',
+            'Domain': 'first.com',
+            'BreachDate': '1970-01-01',
+            'Description': description_html.format(id='first'),
+            'DataClasses': ['Email addresses'],
+            'IsVerified': False,
+        },
+        {
+            'Name': 'SecondExposure',
+            'Title': 'Second Customer Data Exposure',
+            'Domain': 'second.com',
+            'BreachDate': '1970-01-02',
+            'Description': description_html.format(id='second'),
+            'DataClasses': ['Email addresses'],
+            'IsVerified': True,
+        },
+        {
+            'Name': 'ThirdExposure',
+            'Title': 'Third Customer Data Exposure',
+            'Domain': 'third.com',
+            'BreachDate': '1970-01-03',
+            'Description': description_html.format(id='third'),
+            'DataClasses': ['Email addresses', 'Passwords'],
+            'IsVerified': True,
+        },
+    ]
+
+
+def json_chunks(payload, size=64):
+    # Split the payload into small chunks to exercise the streaming parser.
+    data = json.dumps(payload).encode()
+    return iter([data[i:i + size] for i in range(0, len(data), size)])
+
+
+def hibp_api_response(status_code, breaches=None):
     mock_response = mock.MagicMock()
 
     mock_response.status_code = status_code
 
     if status_code == HTTPStatus.OK:
-        description_html = (
-            'This is the <i>{id}</i> breach found on <b>HIBP</b>. Please '
-            'visit the <em>official</em> <a href="{id}.com">website</a> '
-            'to check if your account has been <strong>compromised</strong>.'
+        mock_response.json = lambda: breaches or []
+        mock_response.iter_content = (
+            lambda chunk_size: json_chunks(breaches or [])
         )
-
-        payload_list = [
-            EXPECTED_RESPONSE_OF_JWKS_ENDPOINT,
-            [],
-            [
-                {
-                    'Name': 'FirstExposure',
-                    'Title': 'First Customer Data Exposure',
-                    'Domain': 'first.com',
-                    'BreachDate': '1970-01-01',
-                    'Description': description_html.format(id='first'),
-                    'DataClasses': ['Email addresses'],
-                    'IsVerified': False,
-                },
-                {
-                    'Name': 'SecondExposure',
-                    'Title': 'Second Customer Data Exposure',
-                    'Domain': 'second.com',
-                    'BreachDate': '1970-01-02',
-                    'Description': description_html.format(id='second'),
-                    'DataClasses': ['Email addresses'],
-                    'IsVerified': True,
-                },
-                {
-                    'Name': 'ThirdExposure',
-                    'Title': 'Third Customer Data Exposure',
-                    'Domain': 'third.com',
-                    'BreachDate': '1970-01-03',
-                    'Description': description_html.format(id='third'),
-                    'DataClasses': ['Email addresses', 'Passwords'],
-                    'IsVerified': True,
-                },
-            ],
-            EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
-        ]
-
-        payload_list_iter = iter(payload_list)
-
-        mock_response.json = lambda: next(payload_list_iter)
     elif status_code == HTTPStatus.UNAUTHORIZED:
         mock_response.json = lambda: {
             "message": "Unauthorized error from 3rd party"
         }
     elif status_code == HTTPStatus.TOO_MANY_REQUESTS:
+        mock_response.headers = {'retry-after': '3'}
         mock_response.json = lambda: {
             'message': 'Rate limit is exceeded. Try again in 3 seconds.'
         }
@@ -133,6 +153,28 @@ def hibp_api_response(status_code):
     return mock_response
 
 
+def hibp_api_side_effect(responses):
+    # Emails are looked up concurrently, so respond based on the actual URL
+    # instead of relying on the order of the calls.
+    def _get(url, **kwargs):
+        if url.endswith('/.well-known/jwks'):
+            mock_response = mock.MagicMock()
+            mock_response.json = lambda: EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+            return mock_response
+
+        for email, response in responses.items():
+            if f'/{quote(email, safe="")}?' in url:
+                if isinstance(response, list):
+                    response = response.pop(0)
+                if isinstance(response, Exception):
+                    raise response
+                return response
+
+        return hibp_api_response(HTTPStatus.NOT_FOUND)
+
+    return _get
+
+
 @fixture(scope='module')
 def expected_payload(any_route, client):
     app = client.application
@@ -384,7 +426,12 @@ def test_enrich_call_success(any_route,
     response = None
 
     if any_route.startswith('/observe'):
-        hibp_api_request.return_value = hibp_api_response(HTTPStatus.OK)
+        hibp_api_request.side_effect = hibp_api_side_effect({
+            'dummy@cisco.com': hibp_api_response(HTTPStatus.OK),
+            'dummy@gmail.com': hibp_api_response(
+                HTTPStatus.OK, breaches=hibp_breaches()
+            ),
+        })
 
         response = client.post(any_route,
                                json=valid_json,
@@ -406,13 +453,18 @@ def test_enrich_call_success(any_route,
 
         expected_headers = {
             'User-Agent': app.config['CTR_USER_AGENT'],
-            'hibp-api-key': enrich.get_key()
+            'hibp-api-key': enrich.get_key().key
         }
 
-        hibp_api_request.assert_has_calls([
-            mock.call(expected_url, headers=expected_headers)
-            for expected_url in expected_urls
-        ])
+        expected_timeout = (
+            app.config['HTTP_CONNECT_TIMEOUT'], app.config['HTTP_READ_TIMEOUT']
+        )
+
+        for expected_url in expected_urls:
+            hibp_api_request.assert_any_call(
+                expected_url, headers=expected_headers,
+                stream=True, timeout=expected_timeout
+            )
 
     if any_route.startswith('/refer'):
         response = client.post(any_route, json=valid_json)
@@ -428,7 +480,12 @@ def test_enrich_call_with_external_error_from_hibp_failure(hibp_api_route,
                                                            valid_json,
                                                            hibp_api_request,
                                                            rsa_api_response,
-                                                           valid_jwt):
+                                                           valid_jwt,
+                                                           clear_caches,
+                                                           monkeypatch):
+    # Don't wait for HIBP to lift its rate limit, just give up right away.
+    monkeypatch.setitem(client.application.config, 'HIBP_MAX_WAIT', 1)
+
     for status_code, error_code, error_message, is_authentic in [
         (
                 HTTPStatus.UNAUTHORIZED,
@@ -455,17 +512,9 @@ def test_enrich_call_with_external_error_from_hibp_failure(hibp_api_route,
                 False,
         ),
     ]:
-        app = client.application
+        clear_caches()
 
-        hibp_api_request.side_effect = (
-            rsa_api_response(EXPECTED_RESPONSE_OF_JWKS_ENDPOINT),
-            hibp_api_response(status_code),
-            rsa_api_response(EXPECTED_RESPONSE_OF_JWKS_ENDPOINT)
-        )
-
-        response = client.post(hibp_api_route,
-                               json=valid_json,
-                               headers=headers(valid_jwt()))
+        app = client.application
 
         email = next(
             observable['value']
@@ -473,6 +522,14 @@ def test_enrich_call_with_external_error_from_hibp_failure(hibp_api_route,
             if observable['type'] == 'email'
         )
 
+        hibp_api_request.side_effect = hibp_api_side_effect({
+            email: hibp_api_response(status_code),
+        })
+
+        response = client.post(hibp_api_route,
+                               json=valid_json,
+                               headers=headers(valid_jwt()))
+
         expected_url = app.config['HIBP_API_URL'].format(
             email=quote(email, safe=''),
             truncate='false',
@@ -480,14 +537,20 @@ def test_enrich_call_with_external_error_from_hibp_failure(hibp_api_route,
 
         expected_headers = {
             'User-Agent': app.config['CTR_USER_AGENT'],
-            'hibp-api-key': enrich.get_key()
+            'hibp-api-key': enrich.get_key().key
         }
 
-        calls = [call('https://visibility.amp.cisco.com/.well-known/jwks'),
-                 call(expected_url, headers=expected_headers),
-                 call('https://visibility.amp.cisco.com/.well-known/jwks')]
+        expected_timeout = (
+            app.config['HTTP_CONNECT_TIMEOUT'], app.config['HTTP_READ_TIMEOUT']
+        )
+
+        calls = [call('https://visibility.amp.cisco.com/.well-known/jwks',
+                      timeout=expected_timeout),
+                 call(expected_url, headers=expected_headers,
+                      stream=True, timeout=expected_timeout)]
 
-        hibp_api_request.assert_has_calls(calls)
+        for expected_call in calls:
+            assert expected_call in hibp_api_request.call_args_list
 
         hibp_api_request.reset_mock()
 
@@ -503,3 +566,1069 @@ def test_enrich_call_with_external_error_from_hibp_failure(hibp_api_route,
 
         assert response.status_code == HTTPStatus.OK
         assert response.get_json() == expected_payload
+
+
+def test_enrich_call_with_hibp_timeout_failure(hibp_api_route,
+                                               client,
+                                               valid_json,
+                                               hibp_api_request,
+                                               rsa_api_response,
+                                               valid_jwt):
+    email = next(
+        observable['value']
+        for observable in valid_json
+        if observable['type'] == 'email'
+    )
+
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        email: ReadTimeout(),
+    })
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    expected_payload = {
+        'errors': [
+            {
+                'code': 'service unavailable',
+                'message': (
+                    'Service temporarily unavailable. '
+                    'Please try again later.'
+                ),
+                'type': 'fatal',
+            }
+        ]
+    }
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.get_json() == expected_payload
+
+
+def test_enrich_call_with_broken_hibp_response_failure(hibp_api_route,
+                                                       client,
+                                                       valid_json,
+                                                       hibp_api_request,
+                                                       valid_jwt,
+                                                       monkeypatch):
+    def broken_chunks(chunk_size):
+        yield b'[{"Name": "Adobe"'
+        # What a read timeout looks like while streaming the body.
+        raise ConnectionError('Read timed out.')
+
+    broken = hibp_api_response(HTTPStatus.OK)
+    broken.iter_content = broken_chunks
+
+    truncated = hibp_api_response(HTTPStatus.OK)
+    truncated.iter_content = lambda chunk_size: iter([b'[{"Name": '])
+
+    monkeypatch.setitem(client.application.config,
+                        'CIRCUIT_BREAKER_FAILURE_THRESHOLD', 1)
+
+    for response in (broken, truncated):
+        with client.application.app_context():
+            hibp_breaker.clear()
+
+        hibp_api_request.side_effect = hibp_api_side_effect({
+            'dummy@cisco.com': response,
+        })
+
+        response = client.post(hibp_api_route,
+                               json=valid_json,
+                               headers=headers(valid_jwt()))
+
+        assert response.status_code == HTTPStatus.OK
+        assert response.get_json()['errors'] == [{
+            'code': 'service unavailable',
+            'message': (
+                'Service temporarily unavailable. '
+                'Please try again later.'
+            ),
+            'type': 'fatal',
+        }]
+
+        with client.application.app_context():
+            assert hibp_breaker.state() == 'open'
+
+
+def test_enrich_call_with_partial_data_on_hibp_failure(hibp_api_route,
+                                                       client,
+                                                       valid_json,
+                                                       hibp_api_request,
+                                                       valid_jwt):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.SERVICE_UNAVAILABLE
+        ),
+    })
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    payload = response.get_json()
+
+    assert payload['errors'] == [
+        {
+            'code': 'service unavailable',
+            'message': (
+                'Service temporarily unavailable. Please try again later.'
+            ),
+            'type': 'fatal',
+        }
+    ]
+
+    # The breaches of the first email are kept in their original order.
+    indicators = payload['data']['indicators']['docs']
+    assert [indicator['title'] for indicator in indicators] == [
+        'ThirdExposure', 'SecondExposure', 'FirstExposure'
+    ]
+
+
+def test_enrich_call_with_exhausted_rate_limit_failure(hibp_api_route,
+                                                       client,
+                                                       valid_json,
+                                                       hibp_api_request,
+                                                       valid_jwt):
+    hibp_api_request.side_effect = hibp_api_side_effect({})
+
+    config = {'HIBP_CONCURRENCY': 1, 'HIBP_MAX_WAIT': 1}
+    with mock.patch.dict(client.application.config, config):
+        response = client.post(hibp_api_route,
+                               json=valid_json,
+                               headers=headers(valid_jwt(rate_limit=1)))
+
+    expected_payload = {
+        'errors': [
+            {
+                'code': 'too many requests',
+                'message': 'Rate limit is exceeded. Try again in 60 seconds.',
+                'type': 'fatal',
+            }
+        ]
+    }
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.get_json() == expected_payload
+
+    # The second email has never been sent to HIBP.
+    hibp_calls = [
+        call for call in hibp_api_request.call_args_list
+        if 'breachedaccount' in call.args[0]
+    ]
+    assert len(hibp_calls) == 1
+
+
+def test_enrich_call_with_default_rate_limit_success(hibp_api_route,
+                                                     client,
+                                                     hibp_api_request,
+                                                     valid_jwt):
+    emails = [f'dummy{index}@cisco.com' for index in range(5)]
+
+    hibp_api_request.side_effect = hibp_api_side_effect({})
+
+    response = client.post(
+        hibp_api_route,
+        json=[{'type': 'email', 'value': email} for email in emails],
+        headers=headers(valid_jwt(rate_limit=None)),
+    )
+
+    assert 'errors' not in response.get_json()
+
+    # A burst of lookups within the default rate doesn't wait at all.
+    with client.application.app_context():
+        waits = metrics.rate_limit_wait.get()
+    assert waits['count'] == len(emails)
+    assert waits['0'] == len(emails)
+
+    hibp_calls = [
+        call for call in hibp_api_request.call_args_list
+        if 'breachedaccount' in call.args[0]
+    ]
+    assert len(hibp_calls) == len(emails)
+
+
+def test_enrich_call_with_retry_after_rate_limit_success(hibp_api_route,
+                                                         client,
+                                                         valid_json,
+                                                         hibp_api_request,
+                                                         valid_jwt):
+    rate_limited = hibp_api_response(HTTPStatus.TOO_MANY_REQUESTS)
+    rate_limited.headers = {'retry-after': '1'}
+
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@gmail.com': [
+            rate_limited,
+            hibp_api_response(HTTPStatus.OK, breaches=hibp_breaches()),
+        ],
+    })
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    payload = response.get_json()
+
+    assert 'errors' not in payload
+    assert payload['data']['indicators']['count'] == 3
+
+    with client.application.app_context():
+        [retries] = rate_limiter.stats().values()
+
+    assert retries == {'retries': 1, 'wait_time': 1, 'give_ups': 0}
+
+
+def test_enrich_call_with_cached_breaches_success(hibp_api_route,
+                                                  client,
+                                                  valid_json,
+                                                  hibp_api_request,
+                                                  valid_jwt):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    responses = [
+        client.post(hibp_api_route,
+                    json=valid_json,
+                    headers=headers(valid_jwt()))
+        for _ in range(2)
+    ]
+
+    # Both the breached and the not breached emails are cached.
+    hibp_calls = [
+        call for call in hibp_api_request.call_args_list
+        if 'breachedaccount' in call.args[0]
+    ]
+    assert len(hibp_calls) == 2
+
+    first, second = [response.get_json() for response in responses]
+    assert (
+        first['data']['indicators']['docs'] ==
+        second['data']['indicators']['docs']
+    )
+
+    stats = breach_cache.stats()
+    assert stats['hit_ratio'] == 0.5
+    assert stats['size'] == 2
+
+
+def test_enrich_call_with_breach_cache_bounded_by_size(hibp_api_route,
+                                                       client,
+                                                       valid_json,
+                                                       hibp_api_request,
+                                                       valid_jwt,
+                                                       monkeypatch):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    monkeypatch.setitem(client.application.config,
+                        'BREACH_CACHE_MAX_SIZE', 2048)
+
+    client.post(hibp_api_route,
+                json=valid_json,
+                headers=headers(valid_jwt()))
+
+    stats = breach_cache.stats()
+    assert stats['size'] == 1
+    assert stats['bytes'] <= 2048
+
+
+def test_enrich_call_with_breach_catalog_success(hibp_api_route,
+                                                 client,
+                                                 valid_json,
+                                                 hibp_api_request,
+                                                 valid_jwt,
+                                                 monkeypatch):
+    app = client.application
+
+    truncated_breaches = [
+        {'Name': breach['Name']} for breach in hibp_breaches()
+    ]
+
+    side_effect = hibp_api_side_effect({
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    hibp_api_request.side_effect = side_effect
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    expected_indicators = response.get_json()['data']['indicators']
+
+    def catalog_side_effect(url, **kwargs):
+        if url == app.config['HIBP_BREACHES_URL']:
+            return hibp_api_response(HTTPStatus.OK, breaches=hibp_breaches())
+
+        if url == app.config['HIBP_API_URL'].format(
+                email=quote('dummy@gmail.com', safe=''), truncate='true'
+        ):
+            return hibp_api_response(
+                HTTPStatus.OK, breaches=truncated_breaches
+            )
+
+        return side_effect(url, **kwargs)
+
+    hibp_api_request.side_effect = catalog_side_effect
+
+    monkeypatch.setitem(app.config, 'BREACH_CATALOG_ENABLED', True)
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    assert response.get_json()['data']['indicators'] == expected_indicators
+
+    hibp_api_request.assert_any_call(
+        app.config['HIBP_BREACHES_URL'],
+        headers={'User-Agent': app.config['CTR_USER_AGENT']},
+        stream=True,
+        timeout=mock.ANY,
+    )
+
+
+def test_enrich_call_with_cached_indicators_success(hibp_api_route,
+                                                    client,
+                                                    valid_json,
+                                                    hibp_api_request,
+                                                    valid_jwt):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    with mock.patch('api.mappings.markdownify',
+                    wraps=markdownify) as markdownify_mock:
+        response = client.post(hibp_api_route,
+                               json=valid_json,
+                               headers=headers(valid_jwt()))
+
+    # Each breach has been converted to Markdown only once for both emails.
+    assert markdownify_mock.call_count == 3
+
+    data = response.get_json()['data']
+
+    # Indicators are shared by the sightings of both emails.
+    assert data['indicators']['count'] == 3
+    assert data['sightings']['count'] == 6
+    assert data['relationships']['count'] == 6
+
+    indicator_ids = {
+        indicator['id'] for indicator in data['indicators']['docs']
+    }
+    assert {
+        relationship['target_ref']
+        for relationship in data['relationships']['docs']
+    } == indicator_ids
+
+    breach = Breach.from_json(hibp_breaches()[0])
+
+    with client.application.app_context():
+        indicator = Indicator.map(breach)
+        indicator['tags'].append('Mutated')
+
+        assert Indicator.map(breach)['tags'] == [
+            'Email addresses'
+        ]
+
+
+def test_enrich_call_with_coalesced_lookups_success(client,
+                                                    hibp_api_request):
+    side_effect = hibp_api_side_effect({
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    def slow_side_effect(url, **kwargs):
+        # Make sure that both lookups are in flight at the same time.
+        time.sleep(0.5)
+        return side_effect(url, **kwargs)
+
+    hibp_api_request.side_effect = slow_side_effect
+
+    # Emails are deduplicated within a request, so look up the same one
+    # twice at once as if by concurrent requests.
+    context = TokenContext(
+        key='test_api_key', ctr_entities_limit=100, hibp_rate_limit=6000
+    )
+
+    with client.application.test_request_context():
+        lookups = list(enrich.fetch_breaches_concurrently(
+            context, ['dummy@gmail.com'] * 2
+        ))
+
+    assert [len(breaches) for _, breaches, _ in lookups] == [3, 3]
+
+    hibp_calls = [
+        call for call in hibp_api_request.call_args_list
+        if 'breachedaccount' in call.args[0]
+    ]
+    assert len(hibp_calls) == 1
+    assert breach_flights.stats()['saved'] == 1
+
+
+def test_fetch_breaches_coalesced_across_processes_cached(client,
+                                                          hibp_api_request):
+    app = client.application
+    email = 'dummy@gmail.com'
+
+    ready_fd, done_fd = os.pipe()
+
+    side_effect = hibp_api_side_effect({
+        email: hibp_api_response(HTTPStatus.OK, breaches=hibp_breaches()),
+    })
+
+    def slow_side_effect(url, **kwargs):
+        # Let the other process wait for this very call.
+        os.write(done_fd, b'.')
+        time.sleep(0.5)
+        return side_effect(url, **kwargs)
+
+    hibp_api_request.side_effect = slow_side_effect
+
+    context = TokenContext(
+        key='test_api_key', ctr_entities_limit=100, hibp_rate_limit=6000
+    )
+
+    pid = os.fork()
+    if pid == 0:
+        # Look up the email as if by another worker.
+        try:
+            with app.app_context():
+                fetch_breaches(context, email)
+        finally:
+            os._exit(0)
+
+    os.close(done_fd)
+    os.read(ready_fd, 1)
+
+    try:
+        with app.app_context():
+            breaches, error = fetch_breaches(context, email)
+    finally:
+        os.waitpid(pid, 0)
+        os.close(ready_fd)
+
+    assert error is None
+    assert len(breaches) == 3
+
+    # The results have come from the other process, but are cached here too.
+    hibp_api_request.assert_not_called()
+    assert breach_cache.stats()['size'] == 1
+
+
+def test_enrich_call_with_entities_limit_per_token_success(hibp_api_route,
+                                                           client,
+                                                           valid_json,
+                                                           hibp_api_request,
+                                                           valid_jwt):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    for limit in (1, 2):
+        response = client.post(hibp_api_route,
+                               json=valid_json,
+                               headers=headers(valid_jwt(limit=limit)))
+
+        data = response.get_json()['data']
+        assert data['indicators']['count'] == limit
+        assert data['sightings']['count'] == limit
+
+    # The limit is carried along with the request, not shared by the app.
+    assert 'CTR_ENTITIES_LIMIT' not in client.application.config
+
+
+def test_enrich_call_with_bundle_entities_limit_success(hibp_api_route,
+                                                        client,
+                                                        valid_json,
+                                                        hibp_api_request,
+                                                        valid_jwt,
+                                                        monkeypatch):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    monkeypatch.setitem(client.application.config,
+                        'CTR_BUNDLE_ENTITIES_LIMIT', 7)
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    data = response.get_json()['data']
+
+    # Only the 2 most recent breaches of the first email fit into the budget.
+    assert [
+        indicator['title'] for indicator in data['indicators']['docs']
+    ] == ['ThirdExposure', 'SecondExposure']
+    assert data['sightings']['count'] == 2
+    assert data['relationships']['count'] == 2
+
+
+def test_enrich_call_with_compressed_response_success(hibp_api_route,
+                                                      client,
+                                                      valid_json,
+                                                      hibp_api_request,
+                                                      valid_jwt):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers={**headers(valid_jwt()),
+                                    'Accept-Encoding': 'br;q=0, gzip'})
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+    data = json.loads(gzip.decompress(response.get_data()))
+    assert data['data']['indicators']['count'] == 3
+
+    stats = compression_stats.stats()['gzip']
+    assert stats['responses'] == 1
+    assert stats['compressed_bytes'] == len(response.get_data())
+    assert stats['compressed_bytes'] < stats['uncompressed_bytes']
+
+
+def test_enrich_call_with_uncompressed_response_success(hibp_api_route,
+                                                        client,
+                                                        valid_json,
+                                                        hibp_api_request,
+                                                        valid_jwt,
+                                                        monkeypatch):
+    hibp_api_request.side_effect = hibp_api_side_effect({})
+
+    # Too small to be compressed even though gzip is accepted.
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers={**headers(valid_jwt()),
+                                    'Accept-Encoding': 'gzip'})
+
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_json() == {'data': {}}
+
+    # Large enough, but compression is not accepted.
+    monkeypatch.setitem(client.application.config, 'COMPRESSION_MIN_SIZE', 0)
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    assert 'Content-Encoding' not in response.headers
+
+    assert compression_stats.stats() == {
+        'identity': {
+            'responses': 2,
+            'uncompressed_bytes': 2 * len(response.get_data()),
+            'compressed_bytes': 2 * len(response.get_data()),
+        },
+    }
+
+    # Nothing is recorded with metrics disabled.
+    monkeypatch.setitem(client.application.config, 'METRICS_ENABLED', False)
+
+    client.post(hibp_api_route,
+                json=valid_json,
+                headers=headers(valid_jwt()))
+
+    assert compression_stats.stats()['identity']['responses'] == 2
+
+
+def test_enrich_call_with_server_timing_success(hibp_api_route,
+                                                client,
+                                                valid_json,
+                                                hibp_api_request,
+                                                valid_jwt,
+                                                monkeypatch,
+                                                caplog):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    assert 'Server-Timing' not in response.headers
+
+    monkeypatch.setitem(client.application.config,
+                        'SERVER_TIMING_ENABLED', True)
+
+    caplog.clear()
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    metrics = {
+        metric.split(';')[0]: metric
+        for metric in response.headers['Server-Timing'].split(', ')
+    }
+    assert set(metrics) == {
+        'get_key', 'fetch_breaches', 'Indicator.map', 'Sighting.map',
+        'Relationship.map', 'Bundle.json', 'encode', 'total',
+    }
+    assert metrics['fetch_breaches'].endswith('desc="2 calls"')
+    assert metrics['Indicator.map'].endswith('desc="3 calls"')
+
+    [fields] = [
+        record.msg for record in caplog.records
+        if record.name == client.application.logger.name and
+        record.levelno == logging.INFO
+    ]
+    assert fields['path'] == hibp_api_route
+    assert fields['status'] == HTTPStatus.OK
+    assert fields['timings']['Sighting.map']['calls'] == 3
+
+
+def test_enrich_call_with_open_circuit_breaker_success(hibp_api_route,
+                                                       client,
+                                                       valid_json,
+                                                       hibp_api_request,
+                                                       valid_jwt,
+                                                       monkeypatch):
+    config = client.application.config
+
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    # Cache the lookups as already expired.
+    monkeypatch.setitem(config, 'BREACH_CACHE_TTL', -1)
+    monkeypatch.setitem(config, 'BREACH_CACHE_NEGATIVE_TTL', -1)
+
+    client.post(hibp_api_route,
+                json=valid_json,
+                headers=headers(valid_jwt()))
+
+    hibp_api_request.reset_mock()
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(HTTPStatus.SERVICE_UNAVAILABLE),
+        'dummy@gmail.com': hibp_api_response(HTTPStatus.SERVICE_UNAVAILABLE),
+    })
+
+    monkeypatch.setitem(config, 'CIRCUIT_BREAKER_FAILURE_THRESHOLD', 1)
+    monkeypatch.setitem(config, 'HIBP_CONCURRENCY', 1)
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    # The first 503 opens the circuit, so the second lookup fails fast.
+    hibp_calls = [
+        call for call in hibp_api_request.call_args_list
+        if 'breachedaccount' in call.args[0]
+    ]
+    assert len(hibp_calls) == 1
+    assert hibp_breaker.state() == 'open'
+
+    # Both lookups are served from the outdated cache.
+    data = response.get_json()['data']
+    assert 'errors' not in response.get_json()
+    assert data['indicators']['count'] == 3
+
+    # Without any cached results the errors are reported as before.
+    breach_cache.clear()
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    assert response.get_json()['errors'][0]['code'] == 'service unavailable'
+    assert len(hibp_api_request.call_args_list) == len(hibp_calls)
+
+
+def test_enrich_call_with_expired_deadline_success(hibp_api_route,
+                                                   client,
+                                                   valid_json,
+                                                   hibp_api_request,
+                                                   valid_jwt):
+    hibp_api_request.side_effect = hibp_api_side_effect({})
+
+    # The deadline asked for by the caller passes right away.
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers={**headers(valid_jwt()),
+                                    'X-Request-Timeout': '0.001'})
+
+    # Lookups which can't make it in time are not even started.
+    assert not [
+        call for call in hibp_api_request.call_args_list
+        if 'breachedaccount' in call.args[0]
+    ]
+
+    assert response.get_json() == {
+        'data': {},
+        'errors': [{
+            'code': 'deadline exceeded',
+            'message': 'Not all the observables could be looked up in time. '
+                       'The results are incomplete.',
+            'type': 'warning',
+        }],
+    }
+
+
+def test_enrich_call_with_partial_bundle_on_deadline_success(hibp_api_route,
+                                                             client,
+                                                             valid_json,
+                                                             hibp_api_request,
+                                                             valid_jwt,
+                                                             monkeypatch):
+    monkeypatch.setitem(client.application.config,
+                        'CIRCUIT_BREAKER_FAILURE_THRESHOLD', 1)
+
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+        # The timeout has been cut short by the deadline.
+        'dummy@gmail.com': ReadTimeout(),
+    })
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers={**headers(valid_jwt()),
+                                    'X-Request-Timeout': '2'})
+
+    hibp_call = next(
+        call for call in hibp_api_request.call_args_list
+        if 'breachedaccount' in call.args[0]
+    )
+    assert max(hibp_call.kwargs['timeout']) <= 2
+
+    payload = response.get_json()
+    assert payload['data']['indicators']['count'] == 3
+    assert payload['errors'][0]['code'] == 'deadline exceeded'
+    assert payload['errors'][0]['type'] == 'warning'
+
+    # Timeouts caused by the deadline don't count as HIBP failures.
+    assert hibp_breaker.state() == 'closed'
+
+
+def test_enrich_call_with_lookups_completed_before_deadline_success(
+        hibp_api_route, client, hibp_api_request, valid_jwt
+):
+    # The timeouts have been cut short by the deadline.
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'first@cisco.com': ReadTimeout(),
+        'second@cisco.com': ReadTimeout(),
+        'dummy@cisco.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    emails = ['first@cisco.com', 'second@cisco.com', 'dummy@cisco.com']
+
+    response = client.post(
+        hibp_api_route,
+        json=[{'type': 'email', 'value': email} for email in emails],
+        headers={**headers(valid_jwt()), 'X-Request-Timeout': '2'},
+    )
+
+    payload = response.get_json()
+
+    # The lookups after the timed out ones are still in the bundle.
+    assert payload['data']['indicators']['count'] == 3
+    assert [error['code'] for error in payload['errors']] == [
+        'deadline exceeded'
+    ]
+
+
+def test_enrich_call_with_partial_results_success(hibp_api_route,
+                                                  client,
+                                                  valid_json,
+                                                  hibp_api_request,
+                                                  valid_jwt,
+                                                  monkeypatch):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(HTTPStatus.SERVICE_UNAVAILABLE),
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    monkeypatch.setitem(client.application.config,
+                        'PARTIAL_RESULTS_ENABLED', True)
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    payload = response.get_json()
+
+    # The first failing email doesn't stop the rest from being looked up.
+    assert payload['data']['indicators']['count'] == 3
+    assert payload['data']['sightings']['count'] == 3
+    assert payload['errors'] == [{
+        'code': 'service unavailable',
+        'message': 'Failed to look up dummy@cisco.com: '
+                   'Service temporarily unavailable. '
+                   'Please try again later.',
+        'type': 'warning',
+    }]
+
+
+def test_enrich_call_with_partial_results_on_connection_error(
+        hibp_api_route, client, valid_json, hibp_api_request, valid_jwt,
+        monkeypatch
+):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': ConnectionError('Connection refused'),
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    config = client.application.config
+    monkeypatch.setitem(config, 'PARTIAL_RESULTS_ENABLED', True)
+    monkeypatch.setitem(config, 'CIRCUIT_BREAKER_FAILURE_THRESHOLD', 1)
+    # Look up the emails one by one, the failing one after the other.
+    monkeypatch.setitem(config, 'HIBP_CONCURRENCY', 1)
+
+    response = client.post(hibp_api_route,
+                           json=valid_json[::-1],
+                           headers=headers(valid_jwt()))
+
+    assert response.status_code == HTTPStatus.OK
+
+    payload = response.get_json()
+    assert payload['data']['indicators']['count'] == 3
+    assert [error['code'] for error in payload['errors']] == [
+        'service unavailable'
+    ]
+
+    # Unreachable HIBP counts as a failure.
+    with client.application.app_context():
+        assert hibp_breaker.state() == 'open'
+
+
+def test_enrich_call_with_partial_results_failure(hibp_api_route,
+                                                  client,
+                                                  valid_json,
+                                                  hibp_api_request,
+                                                  valid_jwt,
+                                                  monkeypatch):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': InvalidHeader(),
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    monkeypatch.setitem(client.application.config,
+                        'PARTIAL_RESULTS_ENABLED', True)
+
+    response = client.post(hibp_api_route,
+                           json=valid_json,
+                           headers=headers(valid_jwt()))
+
+    # An invalid API key would fail all the emails, so it's still fatal.
+    payload = response.get_json()
+    assert 'data' not in payload
+    assert payload['errors'][0]['code'] == 'access denied'
+    assert payload['errors'][0]['type'] == 'fatal'
+
+
+def test_enrich_call_with_partial_results_kept_on_failure(hibp_api_route,
+                                                          client,
+                                                          valid_json,
+                                                          hibp_api_request,
+                                                          valid_jwt,
+                                                          monkeypatch):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': InvalidHeader(),
+        'dummy@gmail.com': hibp_api_response(HTTPStatus.SERVICE_UNAVAILABLE),
+    })
+
+    config = client.application.config
+    monkeypatch.setitem(config, 'PARTIAL_RESULTS_ENABLED', True)
+    # Look up the emails one by one, the fatal one after the other.
+    monkeypatch.setitem(config, 'HIBP_CONCURRENCY', 1)
+
+    response = client.post(hibp_api_route,
+                           json=valid_json[::-1],
+                           headers=headers(valid_jwt()))
+
+    # The fatal error still tells which emails have been skipped before.
+    errors = response.get_json()['errors']
+    assert [(error['code'], error['type']) for error in errors] == [
+        ('access denied', 'fatal'),
+        ('service unavailable', 'warning'),
+    ]
+    assert errors[1]['message'].startswith(
+        'Failed to look up dummy@gmail.com: '
+    )
+
+
+def test_enrich_call_with_normalized_emails_success(hibp_api_route,
+                                                    client,
+                                                    hibp_api_request,
+                                                    valid_jwt):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@gmail.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    spellings = [' Dummy@Gmail.com', 'dummy@gmail.com', 'dummy@gmail.com']
+    observables = [
+        {'type': 'email', 'value': spelling} for spelling in spellings
+    ]
+
+    response = client.post(hibp_api_route,
+                           json=observables,
+                           headers=headers(valid_jwt()))
+
+    # All the spellings are looked up only once.
+    hibp_calls = [
+        call for call in hibp_api_request.call_args_list
+        if 'breachedaccount' in call.args[0]
+    ]
+    assert len(hibp_calls) == 1
+    assert quote('dummy@gmail.com', safe='') in hibp_calls[0].args[0]
+
+    # Sightings still refer to the observables exactly as they've been sent.
+    data = response.get_json()['data']
+    assert data['indicators']['count'] == 3
+    assert data['sightings']['count'] == 6
+    assert {
+        sighting['observables'][0]['value']
+        for sighting in data['sightings']['docs']
+    } == {' Dummy@Gmail.com', 'dummy@gmail.com'}
+
+
+def test_refer_call_with_normalized_emails_success(client, valid_jwt):
+    spellings = [' Dummy@Gmail.com', 'dummy@gmail.com', 'dummy@gmail.com']
+    observables = [
+        {'type': 'email', 'value': spelling} for spelling in spellings
+    ]
+
+    response = client.post('/refer/observables',
+                           json=observables,
+                           headers=headers(valid_jwt()))
+
+    # A reference per distinct observable exactly as it's been sent.
+    assert [reference['id'] for reference in response.get_json()['data']] == [
+        f'ref-hibp-search-email-{quote(spelling, safe="")}'
+        for spelling in (' Dummy@Gmail.com', 'dummy@gmail.com')
+    ]
+
+
+def test_enrich_call_with_partial_results_for_spellings(hibp_api_route,
+                                                        client,
+                                                        hibp_api_request,
+                                                        valid_jwt,
+                                                        monkeypatch):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@gmail.com': hibp_api_response(HTTPStatus.SERVICE_UNAVAILABLE),
+    })
+
+    monkeypatch.setitem(client.application.config,
+                        'PARTIAL_RESULTS_ENABLED', True)
+
+    spellings = ['Dummy@Gmail.com', 'dummy@gmail.com']
+    response = client.post(
+        hibp_api_route,
+        json=[{'type': 'email', 'value': spelling} for spelling in spellings],
+        headers=headers(valid_jwt()),
+    )
+
+    [warning] = response.get_json()['errors']
+    assert warning['message'].startswith(
+        'Failed to look up Dummy@Gmail.com, dummy@gmail.com: '
+    )
+
+
+def test_normalize_email_with_idn_success(client, monkeypatch):
+    with client.application.app_context():
+        assert normalize_email(' Ünï@Bücher.Example ') == 'ünï@bücher.example'
+
+        monkeypatch.setitem(client.application.config,
+                            'EMAIL_IDN_ENABLED', True)
+
+        assert normalize_email(' Ünï@Bücher.Example ') == (
+            'ünï@xn--bcher-kva.example'
+        )
+
+        # Values without domains are left as they are.
+        assert normalize_email('Not-An-Email') == 'not-an-email'
+
+
+def test_enrich_call_with_breach_store_success(hibp_api_route,
+                                               client,
+                                               valid_json,
+                                               hibp_api_request,
+                                               valid_jwt,
+                                               monkeypatch):
+    hibp_api_request.side_effect = hibp_api_side_effect({
+        'dummy@cisco.com': hibp_api_response(
+            HTTPStatus.OK, breaches=hibp_breaches()
+        ),
+    })
+
+    monkeypatch.setitem(client.application.config,
+                        'BREACH_STORE_ENABLED', True)
+
+    first = client.post(hibp_api_route,
+                        json=valid_json,
+                        headers=headers(valid_jwt()))
+
+    # As if the worker has been restarted.
+    breach_cache.clear()
+
+    second = client.post(hibp_api_route,
+                         json=valid_json,
+                         headers=headers(valid_jwt()))
+
+    hibp_calls = [
+        call for call in hibp_api_request.call_args_list
+        if 'breachedaccount' in call.args[0]
+    ]
+    assert len(hibp_calls) == 2
+
+    assert (
+        first.get_json()['data']['indicators']['docs'] ==
+        second.get_json()['data']['indicators']['docs']
+    )
+
+    with client.application.app_context():
+        stats = breach_store.stats()
+    assert stats['hits'] == 2
+    assert stats['size'] == 2
+
+    # Promoted entries are served from memory from now on.
+    assert breach_cache.stats()['size'] == 2
@@ -6,6 +6,7 @@ from urllib.parse import quote
 from pytest import fixture
 
 from .utils import headers
+from api.cache import health_cache
 from api.utils import get_key
 from tests.unit.api.mock_for_tests import EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
 
@@ -21,7 +22,7 @@ def route(request):
 
 @fixture(scope='function')
 def hibp_api_request():
-    with mock.patch('requests.get') as mock_request:
+    with mock.patch('requests.Session.get') as mock_request:
         yield mock_request
 
 
@@ -30,11 +31,16 @@ def hibp_api_response(status_code):
 
     mock_response.status_code = status_code
 
-    if status_code == HTTPStatus.UNAUTHORIZED:
+    if status_code == HTTPStatus.OK:
+        mock_response.iter_content = lambda chunk_size: iter([
+            b'[{"Name": "Adobe"}]'
+        ])
+    elif status_code == HTTPStatus.UNAUTHORIZED:
         mock_response.json = lambda: {
             "message": "Unauthorized error from 3rd party"
         }
     elif status_code == HTTPStatus.TOO_MANY_REQUESTS:
+        mock_response.headers = {'retry-after': '3'}
         mock_response.json = lambda: {
             'message': 'Rate limit is exceeded. Try again in 3 seconds.'
         }
@@ -50,7 +56,6 @@ def test_health_call_success(
     hibp_api_request.side_effect = (
         rsa_api_response(EXPECTED_RESPONSE_OF_JWKS_ENDPOINT),
         hibp_api_response(HTTPStatus.OK),
-        rsa_api_response(EXPECTED_RESPONSE_OF_JWKS_ENDPOINT)
     )
 
     response = client.post(route, headers=headers(valid_jwt()))
@@ -64,12 +69,17 @@ def test_health_call_success(
 
     expected_headers = {
         'User-Agent': app.config['CTR_USER_AGENT'],
-        'hibp-api-key': get_key()
+        'hibp-api-key': get_key().key
     }
 
-    calls = [call('https://visibility.amp.cisco.com/.well-known/jwks'),
-             call(expected_url, headers=expected_headers),
-             call('https://visibility.amp.cisco.com/.well-known/jwks')]
+    expected_timeout = (
+        app.config['HTTP_CONNECT_TIMEOUT'], app.config['HTTP_READ_TIMEOUT']
+    )
+
+    calls = [call('https://visibility.amp.cisco.com/.well-known/jwks',
+                  timeout=expected_timeout),
+             call(expected_url, headers=expected_headers,
+                  stream=True, timeout=expected_timeout)]
 
     hibp_api_request.assert_has_calls(calls)
 
@@ -83,7 +93,12 @@ def test_health_call_with_external_error_from_hibp_failure(route,
                                                            client,
                                                            hibp_api_request,
                                                            rsa_api_response,
-                                                           valid_jwt):
+                                                           valid_jwt,
+                                                           clear_caches,
+                                                           monkeypatch):
+    # Don't wait for HIBP to lift its rate limit, just give up right away.
+    monkeypatch.setitem(client.application.config, 'HIBP_MAX_WAIT', 1)
+
     for status_code, error_code, error_message, is_authentic in [
         (
                 HTTPStatus.UNAUTHORIZED,
@@ -110,12 +125,13 @@ def test_health_call_with_external_error_from_hibp_failure(route,
                 False,
         ),
     ]:
+        clear_caches()
+
         app = client.application
 
         hibp_api_request.side_effect = (
             rsa_api_response(EXPECTED_RESPONSE_OF_JWKS_ENDPOINT),
             hibp_api_response(status_code),
-            rsa_api_response(EXPECTED_RESPONSE_OF_JWKS_ENDPOINT)
         )
 
         response = client.post(route, headers=headers(valid_jwt()))
@@ -129,12 +145,17 @@ def test_health_call_with_external_error_from_hibp_failure(route,
 
         expected_headers = {
             'User-Agent': app.config['CTR_USER_AGENT'],
-            'hibp-api-key': get_key()
+            'hibp-api-key': get_key().key
         }
 
-        calls = [call('https://visibility.amp.cisco.com/.well-known/jwks'),
-                 call(expected_url, headers=expected_headers),
-                 call('https://visibility.amp.cisco.com/.well-known/jwks')]
+        expected_timeout = (
+            app.config['HTTP_CONNECT_TIMEOUT'], app.config['HTTP_READ_TIMEOUT']
+        )
+
+        calls = [call('https://visibility.amp.cisco.com/.well-known/jwks',
+                      timeout=expected_timeout),
+                 call(expected_url, headers=expected_headers,
+                      stream=True, timeout=expected_timeout)]
 
         hibp_api_request.assert_has_calls(calls)
 
@@ -152,3 +173,62 @@ def test_health_call_with_external_error_from_hibp_failure(route,
 
         assert response.status_code == HTTPStatus.OK
         assert response.get_json() == expected_payload
+
+
+def test_health_call_with_cached_result_success(route, client,
+                                                hibp_api_request,
+                                                rsa_api_response, valid_jwt):
+    hibp_api_request.side_effect = (
+        rsa_api_response(EXPECTED_RESPONSE_OF_JWKS_ENDPOINT),
+        hibp_api_response(HTTPStatus.OK),
+    )
+
+    for _ in range(2):
+        response = client.post(route, headers=headers(valid_jwt()))
+        assert response.get_json() == {'data': {'status': 'ok'}}
+
+    # Only the JWKS endpoint and then HIBP have been called once.
+    assert hibp_api_request.call_count == 2
+
+    # The JWT is still verified even though the result is cached.
+    response = client.post(route)
+    assert response.get_json()['errors'][0]['code'] == 'authorization error'
+
+    stats = health_cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+
+def test_health_probe_expiring_success(route, client, hibp_api_request,
+                                       rsa_api_response, valid_jwt,
+                                       monkeypatch):
+    app = client.application
+
+    hibp_api_request.side_effect = (
+        rsa_api_response(EXPECTED_RESPONSE_OF_JWKS_ENDPOINT),
+        hibp_api_response(HTTPStatus.OK),
+        hibp_api_response(HTTPStatus.OK),
+    )
+
+    monkeypatch.setitem(app.config, 'HEALTH_PROBE_ENABLED', True)
+    # Don't let the background prober interfere with the test.
+    monkeypatch.setitem(app.config, 'HEALTH_PROBE_INTERVAL', 3600)
+
+    client.post(route, headers=headers(valid_jwt()))
+
+    with app.app_context():
+        # Nothing is about to expire yet.
+        monkeypatch.setitem(app.config, 'HEALTH_PROBE_INTERVAL', 1)
+        health_cache.probe_expiring()
+        assert health_cache.stats()['probes'] == 0
+
+        # The result would expire before the next round.
+        monkeypatch.setitem(app.config, 'HEALTH_PROBE_INTERVAL', 600)
+        health_cache.probe_expiring()
+        assert health_cache.stats()['probes'] == 1
+
+        # The refreshed result doesn't need another probe right away.
+        health_cache.probe_expiring()
+        assert health_cache.stats()['probes'] == 1
+
+    assert hibp_api_request.call_count == 3
@@ -0,0 +1,125 @@
+import os
+from http import HTTPStatus
+from unittest import mock
+
+from pytest import fixture
+
+from .utils import headers
+from api import metrics
+from api.ratelimit import rate_limiter
+from tests.unit.api.mock_for_tests import EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+
+
+def routes():
+    yield '/metrics'
+
+
+@fixture(scope='module', params=routes(), ids=lambda route: f'GET {route}')
+def route(request):
+    return request.param
+
+
+def hibp_api_response(status_code):
+    mock_response = mock.MagicMock()
+
+    mock_response.status_code = status_code
+
+    if status_code == HTTPStatus.OK:
+        mock_response.iter_content = lambda chunk_size: iter([
+            b'[{"Name": "Adobe"}]'
+        ])
+
+    return mock_response
+
+
+def samples(response):
+    return {
+        line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+        for line in response.get_data(as_text=True).splitlines()
+        if not line.startswith('#')
+    }
+
+
+def test_metrics_call_success(route, client, hibp_api_request,
+                              rsa_api_response, valid_jwt):
+    hibp_api_request.side_effect = (
+        rsa_api_response(EXPECTED_RESPONSE_OF_JWKS_ENDPOINT),
+        hibp_api_response(HTTPStatus.SERVICE_UNAVAILABLE),
+        hibp_api_response(HTTPStatus.OK),
+    )
+
+    # Only successful health checks are cached.
+    for _ in range(3):
+        client.post('/health', headers=headers(valid_jwt()))
+
+    response = client.get(route)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.mimetype == 'text/plain'
+
+    values = samples(response)
+
+    assert values['relay_requests_total{route="/health",status="2xx"}'] == 3
+    assert values[
+        'relay_request_duration_seconds_count{route="/health"}'
+    ] == 3
+    assert values[
+        'relay_request_duration_seconds_bucket{route="/health",le="+Inf"}'
+    ] == 3
+    assert values['relay_requests_in_flight{route="/health"}'] == 0
+    # The scrape itself is still being handled.
+    assert values['relay_requests_in_flight{route="/metrics"}'] == 1
+
+    assert values['hibp_request_duration_seconds_count{status="200"}'] == 1
+    assert values['hibp_request_duration_seconds_count{status="503"}'] == 1
+    assert values['hibp_requests_in_flight'] == 0
+    assert values['hibp_rate_limit_wait_seconds_count'] == 2
+
+    assert values['relay_cache_lookups_total{cache="token",result="hits"}'] \
+        == 2
+    assert values['relay_cache_hit_ratio{cache="health"}'] == 1 / 3
+
+
+def test_metrics_aggregated_across_processes_success(route, client):
+    app = client.application
+
+    pid = os.fork()
+    if pid == 0:
+        # Count the request as if it has been handled by another worker.
+        try:
+            with app.app_context():
+                metrics.requests_total.inc('/health', '2xx', amount=3)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    with app.app_context():
+        metrics.requests_total.inc('/health', '2xx')
+
+    values = samples(client.get(route))
+
+    assert values['relay_requests_total{route="/health",status="2xx"}'] == 4
+
+
+def test_metrics_with_rate_limit_retries_success(route, client):
+    with client.application.app_context():
+        rate_limiter.retry('first key', 2)
+        rate_limiter.retry('first key', 3)
+        rate_limiter.give_up('second key')
+
+        stats = rate_limiter.stats()
+
+    first = next(key for key, values in stats.items() if values['retries'])
+    second = next(key for key, values in stats.items() if values['give_ups'])
+
+    values = samples(client.get(route))
+
+    assert values[f'hibp_rate_limit_retries_total{{key="{first}"}}'] == 2
+    assert values[
+        f'hibp_rate_limit_retry_wait_seconds_total{{key="{first}"}}'
+    ] == 5
+    assert values[f'hibp_rate_limit_give_ups_total{{key="{first}"}}'] == 0
+    assert values[f'hibp_rate_limit_give_ups_total{{key="{second}"}}'] == 1
+
+    # Only hashes of the keys are ever exported.
+    assert 'first key' not in client.get(route).get_data(as_text=True)
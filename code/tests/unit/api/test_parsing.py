@@ -0,0 +1,75 @@
+import json
+
+from pytest import raises
+
+from api.breach import Breach
+from api.parsing import iter_breaches, iter_json_array
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_iter_json_array_with_any_chunk_size_success():
+    items = [
+        {'Name': 'Ünïcödé', 'DataClasses': ['Email addresses']},
+        [1, 2.5, None],
+        'string, with [brackets] and "quotes"',
+        12345,
+        True,
+    ]
+    data = json.dumps(items, ensure_ascii=False, indent=2).encode()
+
+    for size in (1, 2, 3, 7, len(data)):
+        assert list(iter_json_array(chunked(data, size))) == items
+
+
+def test_iter_json_array_with_empty_array_success():
+    assert list(iter_json_array([b' [ ', b'] '])) == []
+
+
+def test_iter_json_array_with_truncated_array_failure():
+    data = json.dumps([{'Name': 'First'}, {'Name': 'Second'}]).encode()
+
+    with raises(json.JSONDecodeError):
+        list(iter_json_array(chunked(data[:-5], 4)))
+
+
+def test_iter_breaches_keeps_only_used_fields_success():
+    breach = {
+        'Name': 'Adobe',
+        'Title': 'Adobe',
+        'Domain': 'adobe.com',
+        'BreachDate': '2013-10-04',
+        'ModifiedDate': '2013-12-04T00:00:00Z',
+        'Description': 'In October 2013, ...',
+        'DataClasses': ['Email addresses', 'Passwords'],
+        'IsVerified': True,
+        'LogoPath': 'https://haveibeenpwned.com/Content/Images/Adobe.png',
+        'PwnCount': 152445165,
+        'AddedDate': '2013-12-04T00:00:00Z',
+        'IsSpamList': False,
+    }
+    data = json.dumps([breach, {'Name': 'Truncated'}]).encode()
+
+    first, second = iter_breaches(chunked(data, 10))
+
+    assert first.to_json() == {
+        field: breach[field]
+        for field in ('Name', 'Title', 'Domain', 'BreachDate', 'ModifiedDate',
+                      'Description', 'DataClasses', 'IsVerified')
+    }
+    assert second == Breach('Truncated')
+    assert second.to_json() == {'Name': 'Truncated'}
+
+
+def test_breach_is_immutable_with_shared_data_classes_success():
+    first = Breach.from_json({'Name': 'First', 'DataClasses': ['Passwords']})
+    second = Breach.from_json({'Name': 'Second', 'DataClasses': ['Passwords']})
+
+    assert first.data_classes == ('Passwords',)
+    assert first.data_classes is second.data_classes
+    assert not hasattr(first, '__dict__')
+
+    with raises(AttributeError):
+        first.name = 'Other'
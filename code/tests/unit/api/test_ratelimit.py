@@ -0,0 +1,33 @@
+import time
+from unittest import mock
+
+from pytest import fixture
+
+from api.ratelimit import RateLimiter
+
+
+@fixture
+def rate_limiter(client):
+    with client.application.app_context():
+        rate_limiter = RateLimiter()
+        rate_limiter.clear()
+        yield rate_limiter
+        rate_limiter.clear()
+
+
+def test_rate_limiter_spaces_out_lookups_after_block(rate_limiter):
+    now = time.time()
+
+    with mock.patch('api.ratelimit.time') as time_mock:
+        time_mock.time.return_value = now
+
+        rate_limiter.block('key', 1)
+
+        # All the lookups are waiting at once, as if concurrently.
+        for _ in range(4):
+            assert rate_limiter.acquire('key', 60, now + 60) == 0
+
+    waits = [call.args[0] for call in time_mock.sleep.call_args_list]
+
+    # Each one at its own turn after the block, at the rate of 1 per second.
+    assert waits == [2, 3, 4, 5]
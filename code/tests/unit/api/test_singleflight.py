@@ -0,0 +1,95 @@
+import json
+import os
+import threading
+import time
+
+from api import deadline
+from api.singleflight import SingleFlight
+
+KEY = 'ab' * 32
+
+OTHER_KEY = 'cd' * 32
+
+
+def test_single_flight_shared_wait_bounded_by_deadline(client):
+    app = client.application
+    flights = SingleFlight('test')
+
+    ready_fd, done_fd = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        # Hold the lock for the key as if by a slow call in another worker.
+        try:
+            os.close(ready_fd)
+
+            def func():
+                os.write(done_fd, b'.')
+                time.sleep(2)
+                return 'theirs'
+
+            with app.app_context():
+                flights.do(KEY, func)
+        finally:
+            os._exit(0)
+
+    os.close(done_fd)
+    os.read(ready_fd, 1)
+
+    try:
+        headers = {app.config['REQUEST_TIMEOUT_HEADER']: '0.2'}
+        with app.test_request_context(headers=headers):
+            deadline.start_deadline()
+
+            started_at = time.time()
+            result = flights.do(KEY, lambda: 'ours')
+            waited = time.time() - started_at
+
+            deadline.stop_deadline()
+    finally:
+        os.waitpid(pid, 0)
+        os.close(ready_fd)
+
+    # Gave up waiting for the other process right at the deadline.
+    assert result == 'ours'
+    assert 0.15 < waited < 1
+
+
+def test_single_flight_unshared_result_not_passed_on(client):
+    app = client.application
+    flights = SingleFlight('test', share=lambda result: result != 'leader')
+
+    started = threading.Event()
+    results = {}
+
+    def lookup(name, func):
+        with app.app_context():
+            results[name] = flights.do(OTHER_KEY, func)
+
+    def leader_func():
+        started.set()
+        # Give the follower enough time to join the call.
+        time.sleep(0.3)
+        return 'leader'
+
+    leader = threading.Thread(target=lookup, args=('leader', leader_func))
+    leader.start()
+    started.wait()
+
+    follower = threading.Thread(
+        target=lookup, args=('follower', lambda: 'follower')
+    )
+    follower.start()
+
+    leader.join()
+    follower.join()
+
+    assert results == {'leader': 'leader', 'follower': 'follower'}
+    assert flights.stats()['saved'] == 0
+
+    # Nor is the result passed to other processes.
+    path = os.path.join(
+        app.config['SHARED_STATE_DIR'], 'test-flights', f'{OTHER_KEY}.json'
+    )
+    with open(path) as file:
+        assert json.load(file) == 'follower'
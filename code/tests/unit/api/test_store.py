@@ -0,0 +1,92 @@
+import sqlite3
+
+from pytest import fixture
+
+from api.breach import Breach
+from api.store import breach_store
+
+
+@fixture
+def store(client, monkeypatch):
+    monkeypatch.setitem(client.application.config,
+                        'BREACH_STORE_ENABLED', True)
+
+    with client.application.app_context():
+        yield breach_store
+
+
+def test_store_get_with_ttl_success(store):
+    breaches = [Breach('Adobe', data_classes=['Passwords'])]
+
+    store.set(b'fresh', breaches, ttl=60)
+    store.set(b'expired', breaches, ttl=-1)
+
+    stored, ttl = store.get(b'fresh')
+    assert stored == breaches
+    assert 0 < ttl <= 60
+
+    assert store.get(b'expired') is None
+    assert store.get(b'expired', stale=True)[0] == breaches
+    assert store.get(b'unknown') is None
+
+
+def test_store_sweep_with_max_size_success(store, client, monkeypatch):
+    breaches = [Breach('Adobe', description='x' * 100)]
+
+    for index in range(5):
+        store.set(f'key-{index}'.encode(), breaches, ttl=60 + index)
+    store.set(b'expired', breaches, ttl=-1)
+
+    stats = store.stats()
+    assert stats['size'] == 6
+    size = stats['bytes'] // 6
+
+    # Only the 2 entries to expire last fit (with some room to spare).
+    monkeypatch.setitem(client.application.config,
+                        'BREACH_STORE_MAX_SIZE', int(2.5 * size))
+    store.sweep()
+
+    assert store.stats()['size'] == 2
+    assert store.get(b'expired', stale=True) is None
+    assert store.get(b'key-3') is not None
+    assert store.get(b'key-4') is not None
+    assert store.get(b'key-2') is None
+
+
+def test_store_max_size_on_insert_success(store, client, monkeypatch):
+    breaches = [Breach('Adobe', description='x' * 100)]
+
+    store.set(b'key-0', breaches, ttl=60)
+    size = store.stats()['bytes']
+
+    config = client.application.config
+    monkeypatch.setitem(config, 'BREACH_STORE_MAX_SIZE', int(2.5 * size))
+    # No periodic sweeps in the meantime.
+    monkeypatch.setitem(config, 'BREACH_STORE_SWEEP_INTERVAL', 60 * 60)
+
+    for index in range(1, 5):
+        store.set(f'key-{index}'.encode(), breaches, ttl=60 + index)
+        assert store.stats()['bytes'] <= 2.5 * size
+
+    assert store.get(b'key-4') is not None
+
+
+def test_store_incremental_vacuum_enabled(store):
+    store.set(b'key', [], ttl=60)
+
+    connection = sqlite3.connect(store.get_path())
+    try:
+        [(auto_vacuum,)] = connection.execute('PRAGMA auto_vacuum')
+    finally:
+        connection.close()
+
+    # I.e. incremental (rather than none).
+    assert auto_vacuum == 2
+
+
+def test_store_disabled_success(store, client, monkeypatch):
+    monkeypatch.setitem(client.application.config,
+                        'BREACH_STORE_ENABLED', False)
+
+    store.set(b'key', [], ttl=60)
+    assert store.get(b'key') is None
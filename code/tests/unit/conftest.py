@@ -3,20 +3,54 @@ from unittest import mock
 import jwt
 from pytest import fixture
 
+from api.breaker import hibp_breaker
+from api.cache import (
+    breach_cache, health_cache, indicator_cache, jwks_cache, token_cache
+)
+from api.catalog import breach_catalog
+from api import metrics
+from api.compression import compression_stats
+from api.ratelimit import rate_limiter
+from api.singleflight import breach_flights
+from api.store import breach_store
 from app import app
 from tests.unit.api.mock_for_tests import PRIVATE_KEY
 
 
 @fixture(scope='session')
-def client():
+def client(tmp_path_factory):
     app.rsa_private_key = PRIVATE_KEY
 
     app.testing = True
 
+    app.config['SHARED_STATE_DIR'] = str(tmp_path_factory.mktemp('shared'))
+
     with app.test_client() as client:
         yield client
 
 
+@fixture(autouse=True)
+def clear_caches(client):
+    def _clear_caches():
+        jwks_cache.clear()
+        token_cache.clear()
+        breach_cache.clear()
+        indicator_cache.clear()
+        breach_flights.clear()
+        breach_catalog.clear()
+        with client.application.app_context():
+            rate_limiter.clear()
+            compression_stats.clear()
+            metrics.clear()
+            health_cache.clear()
+            hibp_breaker.clear()
+            breach_store.clear()
+
+    _clear_caches()
+
+    return _clear_caches
+
+
 @fixture(scope='module')
 def valid_json():
     return [
@@ -50,6 +84,7 @@ def valid_jwt(client):
             jwks_host='visibility.amp.cisco.com',
             aud='http://localhost',
             limit=100,
+            rate_limit=6000,
             kid='02B1174234C29F8EFB69911438F597FF3FFEE6B7',
             wrong_structure=False,
             wrong_jwks_host=False
@@ -58,9 +93,13 @@ def valid_jwt(client):
             'key': key,
             'jwks_host': jwks_host,
             'aud': aud,
-            'CTR_ENTITIES_LIMIT': limit
+            'CTR_ENTITIES_LIMIT': limit,
+            'HIBP_RATE_LIMIT': rate_limit,
         }
 
+        if rate_limit is None:
+            payload.pop('HIBP_RATE_LIMIT')
+
         if wrong_jwks_host:
             payload.pop('jwks_host')
 
@@ -79,7 +118,7 @@ def valid_jwt(client):
 
 @fixture(scope='function')
 def hibp_api_request():
-    with mock.patch('requests.get') as mock_request:
+    with mock.patch('requests.Session.get') as mock_request:
         yield mock_request
 
 